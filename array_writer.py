@@ -0,0 +1,95 @@
+import os
+import numpy as np
+
+# Writes fixed size outputs into preallocated uint8 .npy arrays of shape
+# (rows, height, width, channels) instead of image files, so a loader can
+# memory map them and index images without decoding anything.
+#
+# The main process creates every array up front as <name>.npy.tmp. Each input
+# owns a fixed block of rows, so worker processes open the same files and
+# write their disjoint rows directly. The main process collects which rows
+# were filled; close() moves the last rows into any left empty, cuts the
+# array down to the filled rows, writes <name>.txt with the output name of
+# every row and renames the array into place.
+
+class ArrayWriter:
+	def __init__(self, folder):
+		self.folder = folder
+		self.arrays = {}
+		self.filled = []
+
+	def path(self, name):
+		return os.path.join(self.folder, name + '.npy')
+
+	def create(self, name, rows, shape):
+		os.makedirs(self.folder, exist_ok=True)
+		self.arrays[name] = np.lib.format.open_memmap(self.path(name) + '.tmp', mode='w+', dtype=np.uint8, shape=(rows,) + tuple(shape))
+
+	def write(self, name, row, img, label):
+		# returns the path of the array, or None if the image does not fit it
+		if name not in self.arrays:
+			# a worker process, the main process has created the file
+			self.arrays[name] = np.load(self.path(name) + '.tmp', mmap_mode='r+')
+		array = self.arrays[name]
+		if img.shape != array.shape[1:]:
+			print('%s is %s, not %s like the rest of %s.npy: skipped' % (label, 'x'.join(map(str, img.shape)), 'x'.join(map(str, array.shape[1:])), name))
+			return None
+
+		array[row] = img
+		self.filled.append((name, row, label))
+		return self.path(name)
+
+	def take(self):
+		# the rows filled by this process since the last call
+		filled = self.filled
+		self.filled = []
+		return filled
+
+	def merge(self, filled):
+		self.filled.extend(filled)
+
+	def close(self):
+		labels = dict((name, {}) for name in self.arrays)
+		for name, row, label in self.filled:
+			labels[name][row] = label
+
+		for name, array in self.arrays.items():
+			rows = labels[name]
+			# fill the gaps from the end, so only as many rows move as are missing
+			order = sorted(rows)
+			count = len(order)
+			moves = [row for row in order if row >= count]
+			for row in range(count):
+				if row not in rows:
+					last = moves.pop()
+					array[row] = array[last]
+					rows[row] = rows.pop(last)
+			array.flush()
+			del array
+			self.arrays[name] = None
+
+			shrink(self.path(name) + '.tmp', count)
+			with open(self.path(name) + '.txt.tmp', 'w') as f:
+				for row in range(count):
+					f.write(rows[row] + '\n')
+			os.replace(self.path(name) + '.tmp', self.path(name))
+			os.replace(self.path(name) + '.txt.tmp', os.path.splitext(self.path(name))[0] + '.txt')
+
+def shrink(path, rows):
+	# rewrite the .npy header for fewer rows and cut the data after them;
+	# the new header is padded to the old length so the data does not move
+	with open(path, 'r+b') as f:
+		version = np.lib.format.read_magic(f)
+		if version == (1, 0):
+			(shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(f)
+		else:
+			(shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(f)
+		offset = f.tell()
+		# magic string, version and the 2 or 4 byte header length
+		start = 8 + (2 if version == (1, 0) else 4)
+
+		shape = (rows,) + shape[1:]
+		header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), shape)
+		f.seek(start)
+		f.write(header.ljust(offset - start - 1).encode('latin1') + b'\n')
+		f.truncate(offset + rows * int(np.prod(shape[1:])) * dtype.itemsize)
@@ -0,0 +1,44 @@
+import cv2
+
+# The mirror and rotation augmentations: the eight symmetries of a rectangle
+# (flips, quarter turns and transposes), done by moving pixels rather than by
+# warpAffine, so a variant is exact and costs one pass over the image.
+#
+# Every variant is made from the image it augments, never from another
+# variant, and none of them needs a copy made first. rot90, rot270,
+# transposed and transversed swap the width and the height.
+
+VARIANTS = {
+	'flipped': lambda img: cv2.flip(img, 1),
+	'vflipped': lambda img: cv2.flip(img, 0),
+	'rot90': lambda img: cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE),
+	'rot180': lambda img: cv2.rotate(img, cv2.ROTATE_180),
+	'rot270': lambda img: cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE),
+	# mirrored along the main and along the other diagonal
+	'transposed': lambda img: cv2.transpose(img),
+	'transversed': lambda img: cv2.flip(cv2.transpose(img), -1),
+}
+
+# what --mirror and --rotate write
+MIRROR = ['flipped']
+ROTATE = ['rot90', 'rot180', 'rot270']
+
+def select(names, mirror=False, rotate=False):
+	# the variants to write in the order of VARIANTS, each once
+	names = list(names or [])
+	if mirror:
+		names.extend(MIRROR)
+	if rotate:
+		names.extend(ROTATE)
+	unknown = [name for name in names if name not in VARIANTS]
+	if unknown:
+		raise ValueError('unknown augmentation: ' + ', '.join(unknown) + ' (' + ', '.join(VARIANTS) + ')')
+	return [name for name in VARIANTS if name in names]
+
+def suffixes(names):
+	return ['-' + name for name in names]
+
+def augment(img, names):
+	# yields the suffix and image of every variant, one at a time
+	for name in names:
+		yield '-' + name, VARIANTS[name](img)
@@ -0,0 +1,224 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import cv2
+
+# print(cv2.__version__)
+
+def parse_args():
+	desc = "Time the dataset-tools.py transforms on synthetic images, without any file I/O"
+	parser = argparse.ArgumentParser(description=desc)
+
+	parser.add_argument('--sizes', type=str, nargs='+',
+		default=['640x480','1920x1080','4000x3000'],
+		help='Image sizes to generate, as WIDTHxHEIGHT. (default: %(default)s)')
+
+	parser.add_argument('--channels', type=int, nargs='+',
+		default=[1,3,4],
+		help='Channel counts to generate; transforms that do not support one are reported as skipped. (default: %(default)s)')
+
+	parser.add_argument('--transforms', type=str, nargs='+',
+		default=None,
+		help='Transforms to time. ' + str(sorted(TRANSFORMS)) + ' (default: all)')
+
+	parser.add_argument('--max_size', type=int,
+		default=512,
+		help='Target size for image_resize and target width for image_resize_to_rectangle. (default: %(default)s)')
+
+	parser.add_argument('--repeat', type=int,
+		default=20,
+		help='Timed calls per transform and image. (default: %(default)s)')
+
+	parser.add_argument('--warmup', type=int,
+		default=2,
+		help='Untimed calls before the timed ones. (default: %(default)s)')
+
+	parser.add_argument('--threads', type=int,
+		default=None,
+		help='OpenCV threads, e.g. 1 to match a --workers run. (default: OpenCV\'s choice)')
+
+	parser.add_argument('--output', type=str,
+		default=None,
+		help='Write the JSON results to this file instead of the console.')
+
+	parser.add_argument('--baseline', type=str,
+		default=None,
+		help='JSON results of an earlier run to compare the median times against; exits with 1 if any got slower than --tolerance.')
+
+	parser.add_argument('--tolerance', type=float,
+		default=0.1,
+		help='Allowed slowdown against the baseline, 0.1 is 10%%. (default: %(default)s)')
+
+	args = parser.parse_args()
+	return args
+
+def loadTools():
+	# the script name has a dash in it, so it can not be imported by name
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset-tools.py')
+	spec = importlib.util.spec_from_file_location('dataset_tools', path)
+	tools = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(tools)
+	tools.args = tools.parse_args([])
+	tools.inter = cv2.INTER_CUBIC
+	return tools
+
+def syntheticImage(width,height,channels,seed=0):
+	# smooth shapes with some grain, so edges and distances look like a photo's
+	# rather than like noise
+	random = np.random.RandomState(seed)
+	base = random.randint(0, 256, (max(height // 64, 2), max(width // 64, 2), channels)).astype(np.uint8)
+	img = cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC).reshape(height, width, channels)
+	for i in range(8):
+		center = (int(random.randint(0, width)), int(random.randint(0, height)))
+		color = [int(c) for c in random.randint(0, 256, channels)]
+		cv2.circle(img, center, int(random.randint(4, max(min(width, height) // 4, 5))), color, -1)
+	grain = random.randint(-8, 9, img.shape)
+	img = np.clip(img.astype(np.int16) + grain, 0, 255).astype(np.uint8)
+	if channels == 1:
+		img = img[:,:,0]
+	return np.ascontiguousarray(img)
+
+TRANSFORMS = {
+	'image_resize': lambda tools, img, args: tools.image_resize(img, max=args.max_size),
+	'image_resize_to_rectangle': lambda tools, img, args: tools.image_resize_to_rectangle(img, args.max_size, args.max_size * 3 // 5),
+	'crop_to_square': lambda tools, img, args: tools.crop_to_square(img),
+	'processCanny': lambda tools, img, args: tools.processCanny(img),
+	'distance': lambda tools, img, args: tools.distanceImage(img.copy()),
+	'square_padding': lambda tools, img, args: tools.padToSquare(img, max(img.shape[:2])),
+	'rotations': lambda tools, img, args: list(tools.augment.augment(img, tools.augment.ROTATE)),
+	'augment': lambda tools, img, args: list(tools.augment.augment(img, list(tools.augment.VARIANTS))),
+}
+
+# every distance backend, and the exact one at reduced resolution
+for backend in ['opencv','opencv-mask5','opencv-mask3','scipy']:
+	TRANSFORMS['distance-' + backend] = lambda tools, img, args, backend=backend: tools.distance.distance_image(img.copy(), backend)
+for scale in [0.5, 0.25]:
+	TRANSFORMS['distance-opencv-x%g' % scale] = lambda tools, img, args, scale=scale: tools.distance.distance_image(img.copy(), 'opencv', scale=scale)
+
+# a canny sweep made from one resize and grayscale conversion, and the same
+# settings made one --process_type canny run at a time
+SWEEP = (['none','gaussian','median'], [3,5], ['50,150','100,300'])
+
+def cannySweep(tools, img, args, shared):
+	settings = tools.cannySettings(*SWEEP)
+	if shared:
+		tools.shared = {}
+		return [tools.sharedCanny(img, args.max_size, setting) for setting in settings]
+	return [tools.processCanny(tools.image_resize(img, max=args.max_size), setting) for setting in settings]
+
+TRANSFORMS['canny-sweep'] = lambda tools, img, args: cannySweep(tools, img, args, True)
+TRANSFORMS['canny-sweep-separate'] = lambda tools, img, args: cannySweep(tools, img, args, False)
+
+# transforms whose output is compared to that of an exact one
+REFERENCES = dict((name, 'distance-scipy') for name in TRANSFORMS if name.startswith('distance-') and name != 'distance-scipy')
+
+def timeTransform(fn,img,repeat,warmup):
+	for i in range(warmup):
+		fn(img)
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		fn(img)
+		times.append(time.perf_counter() - start)
+	return times
+
+def runBenchmarks(tools,args):
+	results = []
+	names = args.transforms or sorted(TRANSFORMS)
+	for size in args.sizes:
+		(width, height) = [int(n) for n in size.lower().split('x')]
+		for channels in args.channels:
+			img = syntheticImage(width, height, channels)
+			for name in names:
+				result = {'transform': name, 'size': '%dx%d' % (width, height), 'channels': channels}
+				fn = lambda img: TRANSFORMS[name](tools, img, args)
+				try:
+					times = timeTransform(fn, img, args.repeat, args.warmup)
+				except (cv2.error, IndexError, ValueError) as e:
+					result['skipped'] = ' '.join(str(e).split())[:200]
+					results.append(result)
+					print('%-26s %10s x%d  skipped' % (name, result['size'], channels), file=sys.stderr)
+					continue
+
+				ms = np.array(times) * 1000
+				result['images'] = len(times)
+				result['mean_ms'] = round(float(ms.mean()), 4)
+				for p in [50, 90, 99]:
+					result['p%d_ms' % p] = round(float(np.percentile(ms, p)), 4)
+				result['mp_per_s'] = round(width * height / 1e6 / (ms.mean() / 1000), 2)
+				accuracy = ''
+				if name in REFERENCES:
+					# pixel levels away from the exact output
+					diff = np.abs(fn(img).astype(np.int16) - TRANSFORMS[REFERENCES[name]](tools, img, args).astype(np.int16))
+					result['error_mean'] = round(float(diff.mean()), 4)
+					result['error_max'] = int(diff.max())
+					accuracy = '  error mean %.3f max %d' % (result['error_mean'], result['error_max'])
+				results.append(result)
+				print('%-26s %10s x%d  p50 %9.3f ms  p90 %9.3f ms  %8.1f MP/s%s' % (name, result['size'], channels, result['p50_ms'], result['p90_ms'], result['mp_per_s'], accuracy), file=sys.stderr)
+	return results
+
+def resultKey(result):
+	return (result['transform'], result['size'], result['channels'])
+
+def compareBaseline(results,baseline,tolerance):
+	# returns the number of transforms that got slower than allowed
+	previous = dict((resultKey(result), result) for result in baseline['results'] if 'p50_ms' in result)
+	regressions = 0
+	for result in results:
+		old = previous.get(resultKey(result))
+		if old is None or 'p50_ms' not in result:
+			continue
+		change = result['p50_ms'] / old['p50_ms'] - 1
+		result['baseline_p50_ms'] = old['p50_ms']
+		result['change'] = round(change, 4)
+		if change > tolerance:
+			regressions = regressions + 1
+			print('slower: %s %s x%d  p50 %.3f ms -> %.3f ms (%+.0f%%)' % (result['transform'], result['size'], result['channels'], old['p50_ms'], result['p50_ms'], change * 100), file=sys.stderr)
+	return regressions
+
+def main():
+	args = parse_args()
+	if args.transforms:
+		unknown = [name for name in args.transforms if name not in TRANSFORMS]
+		if unknown:
+			sys.exit('unknown transforms: ' + ', '.join(unknown))
+	if args.threads is not None:
+		cv2.setNumThreads(args.threads)
+
+	tools = loadTools()
+	report = {
+		'environment': {
+			'python': platform.python_version(),
+			'numpy': np.__version__,
+			'opencv': cv2.__version__,
+			'platform': platform.platform(),
+			'cpus': os.cpu_count(),
+			'opencv_threads': cv2.getNumThreads(),
+		},
+		'repeat': args.repeat,
+		'results': runBenchmarks(tools, args),
+	}
+
+	regressions = 0
+	if args.baseline:
+		with open(args.baseline) as f:
+			regressions = compareBaseline(report['results'], json.load(f), args.tolerance)
+
+	text = json.dumps(report, indent=1)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(text + '\n')
+	else:
+		print(text)
+
+	if regressions:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
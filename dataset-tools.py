@@ -1,15 +1,31 @@
 import argparse
 import numpy as np
-import scipy.ndimage as pyimg
 import os
-import imutils
 import cv2
 import random
 import math
+import concurrent.futures
+import collections
+from image_probe import image_info
+from manifest import Manifest
+from image_writer import ImageWriter
+import output_profiles
+from output_profiles import get_profile, legacy_profile, PROFILES
+from shard_writer import ShardWriter, ShardBuffer, parse_size, write_index
+from array_writer import ArrayWriter
+from profiling import profiler
+from progress import Progress
+from image_files import walk_images, iter_images
+import augment
+import distance
+from virtual_augment import VirtualIndex, INDEX as VIRTUAL_INDEX
 
 # print(cv2.__version__)
 
-def parse_args():
+# process types whose outputs are always max_size x max_size
+FIXED_SIZE_TYPES = ["square","crop_to_square","crop_center_square","crop_square_patch"]
+
+def parse_args(argv=None):
 	desc = "Tools to normalize an image dataset" 
 	parser = argparse.ArgumentParser(description=desc)
 
@@ -24,21 +40,26 @@ def parse_args():
 		default='./output/',
 		help='Directory path to the outputs folder. (default: %(default)s)')
 
-	parser.add_argument('--process_type', type=str,
-		default='resize',
-		help='Process to use. ["resize","resize_to_rectangle","square","crop_center_square","crop_to_square","canny","canny-pix2pix","crop_square_patch","scale","many_squares","crop","distance"] (default: %(default)s)')
+	parser.add_argument('--process_type', type=str, nargs='+',
+		default=['resize'],
+		help='Process to use; give several to make all of them from one decode. ["resize","resize_to_rectangle","square","crop_center_square","crop_to_square","canny","canny-pix2pix","crop_square_patch","scale","many_squares","crop","distance"] (default: %(default)s)')
 
-	parser.add_argument('--blur_type', type=str,
-		default='none',
-		help='Blur process to use. Use with --process_type canny. ["none","gaussian","median"] (default: %(default)s)')
+	parser.add_argument('--blur_type', type=str, nargs='+',
+		default=['none'],
+		choices=['none','gaussian','median'],
+		help='Blur process to use. Use with --process_type canny; give several to sweep them. ["none","gaussian","median"] (default: %(default)s)')
 
-	parser.add_argument('--blur_amount', type=int, 
-		default=1,
-		help='Amount of blur to apply (use odd numbers). Use with --blur_type.  (default: %(default)s)')
+	parser.add_argument('--blur_amount', type=int, nargs='+',
+		default=[1],
+		help='Amount of blur to apply (use odd numbers). Use with --blur_type; give several to sweep them.  (default: %(default)s)')
 
-	parser.add_argument('--max_size', type=int, 
-		default=512,
-		help='Maximum width or height of the output images. (default: %(default)s)')
+	parser.add_argument('--canny_threshold', type=str, nargs='+',
+		default=['100,300'],
+		help='Low and high threshold of the canny edge maps as LOW,HIGH; give several to sweep them. Every blur and threshold combination is made from one resize and grayscale conversion and written to its own folder. (default: %(default)s)')
+
+	parser.add_argument('--max_size', type=int, nargs='+',
+		default=[512],
+		help='Maximum width or height of the output images; give several sizes to make all of them from one decode. (default: %(default)s)')
 
 	parser.add_argument('--height', type=int, 
 		default=512,
@@ -83,10 +104,48 @@ def parse_args():
 		default='255,255,255',
 		help='border color to use with the `solid` border type; use bgr values (default: %(default)s)')
 
+	parser.add_argument('--distance_backend', type=str,
+		default='opencv',
+		choices=distance.BACKENDS,
+		help='How to work out the distance fields of --process_type distance: opencv is exact like scipy and faster, the mask ones are approximate and faster still. (default: %(default)s)')
+
+	parser.add_argument('--distance_clamp', type=int, nargs=2,
+		default=[32,200],
+		help='Largest distance kept in the green (light to dark) and blue (dark to light) channels of --process_type distance, at most 255. (default: %(default)s)')
+
+	parser.add_argument('--distance_scale', type=float,
+		default=1.0,
+		help='Work out the distance fields at this fraction of the output size and resize them back; faster, less exact near edges. (default: %(default)s)')
+
+	parser.add_argument('--many_squares_mode', type=str,
+		default='pairs',
+		choices=['pairs','tiles'],
+		help='pairs takes a square from each end of a long image and one from the middle of others; tiles covers the image with squares of --tile_size every --tile_stride, resized once and sliced, and writes them with the output profile of the run. (default: %(default)s)')
+
+	parser.add_argument('--tile_size', type=int,
+		default=0,
+		help='Side of a --many_squares_mode tiles square in input pixels; 0 uses the short side of every image. (default: %(default)s)')
+
+	parser.add_argument('--tile_stride', type=float,
+		default=1.0,
+		help='Step between --many_squares_mode tiles squares as a fraction of their size; below 1 they overlap. (default: %(default)s)')
+
+	parser.add_argument('--tile_coverage', type=float,
+		default=0.25,
+		help='Where the tiles stop short of the right or bottom edge, add one flush with the edge when the strip left out is at least this fraction of a tile; 0 always covers the whole image. (default: %(default)s)')
+
 	parser.add_argument('--jpeg_quality', type=int,
 		default=100,
 		help='the quality for jpeg to be saved; use 90 or 100 for most of the cases (default: %(default)s)')
 
+	parser.add_argument('--output_profile', type=str,
+		default=None,
+		help='Encoder settings for every output, NAME or NAME:LEVEL (compression level or quality); replaces --file_extension and --jpeg_quality. ' + str(sorted(PROFILES)) + ' (default: png-raw, or jpg with --jpeg_quality when --file_extension jpg)')
+
+	parser.add_argument('--edge_profile', type=str,
+		default=None,
+		help='Encoder settings for canny edge maps. (default: png-bilevel when the other outputs are png, else the same as them)')
+
 	# parser.add_argument('--blur_size', type=int, 
 	# 	default=3,
 	# 	help='Blur size. For use with "canny" process. (default: %(default)s)')
@@ -97,19 +156,236 @@ def parse_args():
 	parser.add_argument('--rotate', action='store_true',
 		help='Adds 90 degree rotation augmentation.')
 
+	parser.add_argument('--augment', type=str, nargs='+',
+		default=[],
+		choices=list(augment.VARIANTS),
+		help='Mirrored and rotated copies to write next to every output; --mirror adds flipped, --rotate adds rot90 rot180 rot270. (default: none)')
+
+	parser.add_argument('--augment_mode', type=str,
+		default='files',
+		choices=['files','virtual'],
+		help='files writes the --augment variants and the crops of crop_square_patch and many_squares as images; virtual only lists how to make them in virtual.jsonl, for virtual_augment.py to apply when reading. (default: %(default)s)')
+
 	parser.add_argument('--file_extension', type=str,
 		default='png',
 		help='Border style to use when using the square process type ["png","jpg"] (default: %(default)s)')
 
+	parser.add_argument('--exact_decode', action='store_true',
+		help='Always decode JPEGs at full resolution, even when the output is much smaller.')
+
+	parser.add_argument('--force', action='store_true',
+		help='Process every image again, even the ones the manifest in the output folder marks as done.')
+
+	parser.add_argument('--writer_threads', type=int,
+		default=2,
+		help='Threads that encode and write images while the next image is processed; 0 writes them in place. (default: %(default)s)')
+
+	parser.add_argument('--write_queue', type=int,
+		default=32,
+		help='Maximum number of images waiting to be written before processing waits for the writer. (default: %(default)s)')
+
+	parser.add_argument('--workers', type=int,
+		default=1,
+		help='Number of processes to spread the images across; use 0 for one per core. (default: %(default)s)')
+
+	parser.add_argument('--profile', action='store_true',
+		help='Time every stage of the run (listing, reading, each process type, encoding, writing) and print a summary; a Chrome trace is written to profile-trace.json in the output folder.')
+
+	parser.add_argument('--output_format', type=str,
+		default='files', choices=['files','tar','npy'],
+		help='Write every output as its own file, pack them into tar shards with an index, or write them into one memory mapped .npy array per folder (fixed size process types only). (default: %(default)s)')
+
+	parser.add_argument('--shard_size', type=str,
+		default='1G',
+		help='Size at which a new tar shard is started when using --output_format tar, e.g. 256M. (default: %(default)s)')
+
 	feature_parser = parser.add_mutually_exclusive_group(required=False)
 	feature_parser.add_argument('--keep_name', dest='name', action='store_true')
 	feature_parser.add_argument('--numbered', dest='name', action='store_false')
 	parser.set_defaults(name=True)
 
-	args = parser.parse_args()
+	args = parser.parse_args(argv)
+
+	# these all write to the sq-<size> folders
+	square_types = [p for p in args.process_type if p in ["square","crop_to_square","crop_square_patch"]]
+	if len(square_types) > 1:
+		parser.error('--process_type ' + ' and '.join(square_types) + ' would overwrite each other\'s sq- folders')
+
+	args.augment = augment.select(args.augment, args.mirror, args.rotate)
+
+	for name in ['output_profile','edge_profile']:
+		if getattr(args, name):
+			try:
+				get_profile(getattr(args, name))
+			except ValueError as e:
+				parser.error('--' + name + ': ' + str(e))
+
+	try:
+		args.canny_settings = cannySettings(args.blur_type, args.blur_amount, args.canny_threshold)
+	except ValueError as e:
+		parser.error(str(e))
+
+	if not all(0 <= clamp <= 255 for clamp in args.distance_clamp):
+		parser.error('--distance_clamp values must be between 0 and 255')
+	if not 0 < args.distance_scale <= 1:
+		parser.error('--distance_scale must be above 0 and at most 1')
+	if args.tile_size < 0 or args.tile_stride <= 0 or args.tile_coverage < 0:
+		parser.error('--tile_size, --tile_stride and --tile_coverage can not be negative, and --tile_stride must be above 0')
+
+	if args.output_format == 'npy' and args.augment_mode == 'virtual':
+		parser.error('--augment_mode virtual needs the base images as files or tar members, not array rows')
+
+	if args.output_format == 'npy':
+		other_types = [p for p in args.process_type if p not in FIXED_SIZE_TYPES]
+		if other_types:
+			parser.error('--output_format npy needs every output to have the same size, which ' + ', '.join(other_types) + ' do not')
+
 	return args
 
 
+def cannySettings(blur_types, blur_amounts, thresholds):
+	# every (blur_type, blur_amount, low, high) to make edge maps with
+	pairs = []
+	for threshold in thresholds:
+		try:
+			(low, high) = [int(value) for value in threshold.split(',')]
+		except ValueError:
+			raise ValueError('--canny_threshold takes LOW,HIGH pairs, not ' + threshold)
+		pairs.append((low, high))
+
+	settings = []
+	for blur_type in blur_types:
+		for blur_amount in (blur_amounts if blur_type != 'none' else [0]):
+			if blur_type != 'none' and (blur_amount < 1 or blur_amount % 2 == 0):
+				raise ValueError('--blur_amount must be odd and positive, not ' + str(blur_amount))
+			for (low, high) in pairs:
+				if (blur_type, blur_amount, low, high) not in settings:
+					settings.append((blur_type, blur_amount, low, high))
+	return settings
+
+def cannyName(setting):
+	# the folder suffix of a setting in a sweep, e.g. gaussian5-100-300
+	(blur_type, blur_amount, low, high) = setting
+	name = '%d-%d' % (low, high)
+	if blur_type != 'none':
+		name = blur_type + str(blur_amount) + '-' + name
+	return name
+
+def makeDir(path,virtual=False):
+	# workers can race to create the same folder, and every image asks for it;
+	# with --augment_mode virtual the folder is made by writeImage, as the
+	# folders of crops only get records in virtual.jsonl
+	if args.augment_mode == 'virtual' and not virtual:
+		return
+	if args.output_format == 'files' and path not in made_dirs:
+		with profiler.stage('makedirs'): os.makedirs(path, exist_ok=True)
+		made_dirs.add(path)
+
+def sharedResize(key, img, scale, resize=None):
+	# resized versions are kept for the rest of the image, and a new size starts
+	# from the smallest version that is still bigger than it, so a pyramid of
+	# sizes costs little more than the first resize
+	if (key, scale) in shared:
+		return shared[(key, scale)]
+
+	source = img
+	for (k, s), version in shared.items():
+		if k == key and s > scale and version.shape[0] * version.shape[1] < source.shape[0] * source.shape[1]:
+			source = version
+
+	if resize is None:
+		resized = image_resize(source, max = scale)
+	else:
+		resized = resize(source, scale)
+	shared[(key, scale)] = resized
+	return resized
+
+def sharedGray(img, scale, blur_type, blur_amount):
+	# every setting of a sweep starts from one grayscale version per size,
+	# and the settings that only differ in their thresholds from one blur
+	if ('gray', scale) not in shared:
+		shared[('gray', scale)] = cv2.cvtColor(sharedResize('full', img, scale), cv2.COLOR_BGR2GRAY)
+	key = 'blur-' + blur_type + str(blur_amount)
+	if (key, scale) not in shared:
+		shared[(key, scale)] = blurGray(shared[('gray', scale)], blur_type, blur_amount)
+	return shared[(key, scale)]
+
+def sharedCanny(img, scale, setting=None):
+	# canny and canny-pix2pix find the same edges for a size; canny-pix2pix
+	# uses the first setting of a sweep
+	if setting is None:
+		setting = args.canny_settings[0]
+	key = 'canny-' + cannyName(setting)
+	if (key, scale) not in shared:
+		(blur_type, blur_amount, low, high) = setting
+		shared[(key, scale)] = cv2.Canny(sharedGray(img, scale, blur_type, blur_amount), low, high)
+	return shared[(key, scale)]
+
+def setupProfiles():
+	global output_profile
+	global png_profile
+	global edge_profile
+	if args.output_profile:
+		output_profile = get_profile(args.output_profile)
+		png_profile = output_profile
+	else:
+		output_profile = legacy_profile(args.file_extension, args.jpeg_quality)
+		# the writers that have always written uncompressed png keep doing so
+		png_profile = get_profile('png-raw')
+	if args.edge_profile:
+		edge_profile = get_profile(args.edge_profile)
+	elif output_profile.extension == '.png':
+		# edge maps are only ever 0 or 255, so 1 bit per pixel loses nothing
+		edge_profile = get_profile('png-bilevel')
+	else:
+		edge_profile = output_profile
+
+def encodeImage(img,file_path,profile):
+	# returns where the output ended up: its own file, the tar shard it was
+	# added to, or None when a worker passes it on to the main process
+	data = output_profiles.encode(img, profile)
+	profiler.count('write', len(data))
+	if shards is not None:
+		with profiler.stage('write'):
+			return shards.add(os.path.relpath(file_path, args.output_folder), data)
+
+	# encode in memory and move the finished file into place, so an
+	# interrupted run never leaves a truncated image behind
+	with profiler.stage('write'):
+		(path, new_file) = os.path.split(file_path)
+		tmp_path = os.path.join(path, '.' + new_file + '.tmp')
+		with open(tmp_path, 'wb') as f:
+			f.write(data)
+		os.replace(tmp_path, file_path)
+	return file_path
+
+def writeImage(img,path,new_file,profile):
+	# with writer threads this only queues the image, so it must not be
+	# changed after it has been handed over
+	file_path = os.path.join(path, new_file)
+	if args.augment_mode == 'virtual':
+		makeDir(path, virtual=True)
+	if writer is None:
+		written.append(encodeImage(img, file_path, profile))
+	else:
+		writes.append(writer.submit(encodeImage, img, file_path, profile))
+
+def saveImage(img,path,filename,suffix="",profile=None):
+	if profile is None:
+		profile = output_profile
+	new_file = os.path.splitext(filename)[0] + suffix + profile.extension
+	if arrays is not None:
+		# every input owns one row per variant in the array of the folder
+		row = image_index * len(variants) + variants.index(suffix)
+		with profiler.stage('write'):
+			array_path = arrays.write(os.path.basename(os.path.normpath(path)), row, img, new_file)
+		profiler.count('write', img.nbytes)
+		if array_path is not None:
+			written.append(array_path)
+	else:
+		writeImage(img, path, new_file, profile)
+	return new_file
+
 def image_resize(image, width = None, height = None, max = None):
 	# initialize the dimensions of the image to be resized and
 	# grab the image size
@@ -161,10 +437,10 @@ def image_resize_to_rectangle(image, target_width=1280, target_height=768, allow
 	dim = None
 	(h, w) = image.shape[:2]
 
-    if allow_rotating and h > w:
-        # why not rotating it ?
-        image = imutils.rotate_bound(image, 90)
-        (h, w) = image.shape[:2]
+	if allow_rotating and h > w:
+		# why not rotating it ?
+		image = augment.VARIANTS["rot90"](image)
+		(h, w) = image.shape[:2]
 
 	need_to_stretch = h < target_height or w < target_width
 	if need_to_stretch: # for smaller images we just do a raw resize dont care about ratio or proprotions
@@ -251,10 +527,9 @@ def arbitrary_crop(img, h_crop,w_crop):
 def crop_to_square(img):
 	(h, w) = img.shape[:2]
 	
-	cropped = img.copy()
+	cropped = img
 	if w > h:	
 		if (args.h_align=='left'):
-			print('here first')
 			cropped = img[:h,:h]
 		elif (args.h_align=='right'):
 			cropped = img[0:h, w-h:w]
@@ -272,12 +547,15 @@ def crop_to_square(img):
 		
 	return cropped
 
-def crop_center_square(img, size, interpolation=cv2.INTER_AREA):
+def center_square(img):
 	h, w = img.shape[:2]
 	min_size = np.amin([h,w])
 
 	# Centralize and crop
-	crop_img = img[int(h/2-min_size/2):int(h/2+min_size/2), int(w/2-min_size/2):int(w/2+min_size/2)]
+	return img[int(h/2-min_size/2):int(h/2+min_size/2), int(w/2-min_size/2):int(w/2+min_size/2)]
+
+def crop_center_square(img, size, interpolation=cv2.INTER_AREA):
+	crop_img = center_square(img)
 	resized = cv2.resize(crop_img, (size, size), interpolation=interpolation)
 
 	return resized
@@ -291,113 +569,97 @@ def crop_square_patch(img, imgSize):
 
 	return cropped
 
-def processCanny(img):
+def blurGray(gray, blur_type, blur_amount):
+	if(blur_type=='gaussian'):
+		gray = cv2.GaussianBlur(gray, (blur_amount, blur_amount), 0)
+	elif(blur_type=='median'):
+		gray = cv2.medianBlur(gray,blur_amount)
+	return gray
+
+def processCanny(img, setting=None):
+	if setting is None:
+		setting = args.canny_settings[0]
+	(blur_type, blur_amount, low, high) = setting
 	gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-	
-	if(args.blur_type=='gaussian'):
-		gray = cv2.GaussianBlur(gray, (args.blur_amount, args.blur_amount), 0)
-	elif(args.blur_type=='median'):
-		gray = cv2.medianBlur(gray,args.blur_amount)
-	gray = cv2.Canny(gray,100,300)
+	gray = blurGray(gray, blur_type, blur_amount)
+	gray = cv2.Canny(gray,low,high)
 
 	return gray
 
 def makeResize(img,filename,scale):
 
 	remakePath = args.output_folder + str(scale)+"/"
-	if not os.path.exists(remakePath):
-		os.makedirs(remakePath)
+	makeDir(remakePath)
 
-	img_copy = img.copy()
-	img_copy = image_resize(img_copy, max = scale)
+	img_copy = sharedResize('full', img, scale)
 
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+	new_file = saveImage(img_copy, remakePath, filename)
 
-	if (args.mirror): flipImage(img_copy,new_file,remakePath)
-	if (args.rotate): rotateImage(img_copy,new_file,remakePath)
+	augmentImage(img_copy,new_file,remakePath)
 
 def makeResizeToRectangle(img,filename,width,height,allow_rotating):
 	remakePath = args.output_folder + "-resize_rectangle-"+str(width)+"x"+str(height)+"/"
-	if not os.path.exists(remakePath):
-		os.makedirs(remakePath)
+	makeDir(remakePath)
 
 	img_copy = img.copy()
 	img_copy = image_resize_to_rectangle(img_copy, target_width = width, target_height = height, allow_rotating=allow_rotating)
 
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+	new_file = saveImage(img_copy, remakePath, filename)
+
+	augmentImage(img_copy,new_file,remakePath)
 
-	if (args.mirror): flipImage(img_copy,new_file,remakePath)
-	if (args.rotate): rotateImage(img_copy,new_file,remakePath)
+def distanceImage(img):
+	# distance to the nearest dark pixel in green, to the nearest light one in blue
+	return distance.distance_image(img, args.distance_backend, args.distance_clamp, args.distance_scale)
 
 def makeDistance(img,filename,scale):
-	makePath = args.output_folder + "distance-"+ str(args.max_size)+"/"
-	if not os.path.exists(makePath):
-		os.makedirs(makePath)
+	makePath = args.output_folder + "distance-"+ str(scale)+"/"
+	makeDir(makePath)
 
-	img_copy = img.copy()
-	img_copy = image_resize(img_copy, max = scale)
-
-	BW = img_copy[:,:,0] > 127
-	G_channel = pyimg.distance_transform_edt(BW)
-	G_channel[G_channel>32]=32
-	B_channel = pyimg.distance_transform_edt(1-BW)
-	B_channel[B_channel>200]=200
-	img_copy[:,:,1] = G_channel.astype('uint8')
-	img_copy[:,:,0] = B_channel.astype('uint8')
-
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(makePath, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(makePath, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-	if (args.mirror): flipImage(img_copy,new_file,makePath)
-	if (args.rotate): rotateImage(img_copy,new_file,makePath)
+	# the channels are overwritten, so take a copy of the shared resize
+	img_copy = distanceImage(sharedResize('full', img, scale).copy())
+
+	new_file = saveImage(img_copy, makePath, filename)
+
+	augmentImage(img_copy,new_file,makePath)
 
 def makeScale(img,filename,scale):
 
 	remakePath = args.output_folder + "scale_"+str(scale)+"/"
-	if not os.path.exists(remakePath):
-		os.makedirs(remakePath)
+	makeDir(remakePath)
 
 	img_copy = img.copy()
 	
 	img_copy = image_scale(img_copy, scale)
 
-	new_file = os.path.splitext(filename)[0] + ".png"
-	cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
+	new_file = saveImage(img_copy, remakePath, filename, "", png_profile)
 
-	if (args.mirror): flipImage(img_copy,new_file,remakePath)
-	if (args.rotate): rotateImage(img_copy,new_file,remakePath)
+	augmentImage(img_copy,new_file,remakePath)
 
 
 def makeSquare(img,filename,scale):
 	sqPath = args.output_folder + "sq-"+str(scale)+"/"
-	if not os.path.exists(sqPath):
-		os.makedirs(sqPath)
+	makeDir(sqPath)
+
+	img_sq = img
+	(h, w) = img_sq.shape[:2]
+	if((h < scale) and (w < scale)):
+		if(args.verbose): print('skip resize')
+	else:
+		img_sq = sharedResize('full', img, scale)
 
+	img_sq = padToSquare(img_sq, scale)
+
+	new_file = saveImage(img_sq, sqPath, filename)
+
+	augmentImage(img_sq,new_file,sqPath)
+
+def padToSquare(img_sq,scale):
 	bType = cv2.BORDER_REPLICATE
 	if(args.border_type == 'solid'):
 		bType = cv2.BORDER_CONSTANT
 	elif (args.border_type == 'reflect'):
 		bType = cv2.BORDER_REFLECT
-	img_sq = img.copy()
-	(h, w) = img_sq.shape[:2]
-	if((h < scale) and (w < scale)):
-		if(args.verbose): print('skip resize')
-	else:
-		img_sq = image_resize(img_sq, max = scale)
 
 	bColor = [int(item) for item in args.border_color.split(',')]
 
@@ -423,257 +685,349 @@ def makeSquare(img,filename,scale):
 		else:
 			img_sq = cv2.copyMakeBorder(img_sq, int(diff/2), int(diff/2)+1, int(diff/2), int(diff/2)+1, bType,value=bColor)
 
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(sqPath, new_file), img_sq, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(sqPath, new_file), img_sq, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-	if (args.mirror): flipImage(img_sq,new_file,sqPath)
-	if (args.rotate): rotateImage(img_sq,new_file,sqPath)
+	return img_sq
 
 	
 	
 
 def makeCanny(img,filename,scale):
-	make_path = args.output_folder + "canny-"+str(scale)+"/"
-	if not os.path.exists(make_path):
-		os.makedirs(make_path)
+	for setting in args.canny_settings:
+		# a sweep writes every setting to its own folder
+		make_path = args.output_folder + "canny-"+str(scale)+"/"
+		if len(args.canny_settings) > 1:
+			make_path = args.output_folder + "canny-"+str(scale)+"-"+cannyName(setting)+"/"
+		makeDir(make_path)
 
-	img_copy = img.copy()
-	img_copy = image_resize(img_copy, max = scale)
-	gray = processCanny(img_copy)
+		gray = sharedCanny(img, scale, setting)
 
-	# save out
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(make_path, new_file), gray, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(make_path, new_file), gray, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+		# save out
+		new_file = saveImage(gray, make_path, filename, profile=edge_profile)
 
-	if (args.mirror): flipImage(img_copy,new_file,make_path)
-	if (args.rotate): rotateImage(img_copy,new_file,make_path)
+		augmentImage(gray,new_file,make_path,edge_profile)
 
 def makeCrop(img,filename):
 	make_path = args.output_folder + "crop-"+str(args.height)+"x"+str(args.width)+"/"
-	if not os.path.exists(make_path):
-		os.makedirs(make_path)
+	makeDir(make_path)
 
 	img_copy = img.copy()
 	img_copy,error = arbitrary_crop(img_copy,args.height,args.width)
 
 	if (error==False):
-		if(args.file_extension == "png"):
-			new_file = os.path.splitext(filename)[0] + ".png"
-			cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-		elif(args.file_extension == "jpg"):
-			new_file = os.path.splitext(filename)[0] + ".jpg"
-			cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-		if (args.mirror): flipImage(img_copy,new_file,make_path)
-		if (args.rotate): rotateImage(img_copy,new_file,make_path)
+		new_file = saveImage(img_copy, make_path, filename)
+
+		augmentImage(img_copy,new_file,make_path)
 	else:
 		if(args.verbose): print(filename+" returned an error")
 
 def makeCropCenterSquare(img,filename,max_size):
 	make_path = args.output_folder + "crop-center-square-"+str(max_size)+"/"
-	if not os.path.exists(make_path):
-		os.makedirs(make_path)
-	img_copy = img.copy()
-	img_copy = crop_center_square(img_copy, max_size)
+	makeDir(make_path)
+	img_copy = sharedResize('center_square', center_square(img), max_size, lambda crop, size: cv2.resize(crop, (size, size), interpolation=cv2.INTER_AREA))
 
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+	new_file = saveImage(img_copy, make_path, filename)
 
-	if (args.mirror): flipImage(img_copy,new_file,make_path)
-	if (args.rotate): rotateImage(img_copy,new_file,make_path)
+	augmentImage(img_copy,new_file,make_path)
 
 def makeSquareCrop(img,filename,scale):
 	make_path = args.output_folder + "sq-"+str(scale)+"/"
-	if not os.path.exists(make_path):
-		os.makedirs(make_path)
+	makeDir(make_path)
 
-	img_copy = img.copy()
-	img_copy = crop_to_square(img_copy)
-	img_copy = image_resize(img_copy, max = scale)
+	img_copy = sharedResize('crop_to_square', crop_to_square(img), scale)
 
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+	new_file = saveImage(img_copy, make_path, filename)
 
-	if (args.mirror): flipImage(img_copy,new_file,make_path)
-	if (args.rotate): rotateImage(img_copy,new_file,make_path)
+	augmentImage(img_copy,new_file,make_path)
 
 def makeManySquares(img,filename,scale):
 	make_path = args.output_folder + "many_squares-"+str(scale)+"/"
-	if not os.path.exists(make_path):
-		os.makedirs(make_path)
+	makeDir(make_path)
 
-	img_copy = img.copy()
+	if args.many_squares_mode == 'tiles':
+		makeTiles(img,filename,scale,make_path)
+		return
+
+	img_copy = img
 	(h, w) = img_copy.shape[:2]
 	img_ratio = h/w
 
 	if(img_ratio >= 1.25):
 
 		#crop images from top and bottom
-		crop = img_copy[0:w,0:w]
-		crop = image_resize(crop, max = scale)
-		new_file = os.path.splitext(filename)[0] + "-1.png"
-		cv2.imwrite(os.path.join(make_path, new_file), crop, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-		if (args.mirror): flipImage(crop,new_file,make_path)
-		if (args.rotate): rotateImage(crop,filename,make_path)
-
-		crop = img_copy[h-w:h,0:w]
-		crop = image_resize(crop, max = scale)
-		new_file = os.path.splitext(filename)[0] + "-2.png"
-		cv2.imwrite(os.path.join(make_path, new_file), crop, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-		if (args.mirror): flipImage(crop,new_file,make_path)
-		if (args.rotate): rotateImage(crop,filename,make_path)
+		saveCrop(img_copy, img_copy[0:w,0:w], make_path, filename, "-1", 'top', scale)
+		saveCrop(img_copy, img_copy[h-w:h,0:w], make_path, filename, "-2", 'bottom', scale)
 
 	elif(img_ratio <= .8):
 		#crop images from left and right
-		print(os.path.splitext(filename)[0] + ': wide image')
+		if(args.verbose): print(os.path.splitext(filename)[0] + ': wide image')
 		
-		crop = img_copy[0:h,0:h]
-		crop = image_resize(crop, max = scale)
-		new_file = os.path.splitext(filename)[0] + "-wide1.png"
-		cv2.imwrite(os.path.join(make_path, new_file), crop, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-		if (args.mirror): flipImage(crop,new_file,make_path)
-		if (args.rotate): rotateImage(crop,filename,make_path)
-
-		crop = img_copy[0:h,w-h:w]
-		crop = image_resize(crop, max = scale)
-		new_file = os.path.splitext(filename)[0] + "-wide2.png"
-		cv2.imwrite(os.path.join(make_path, new_file), crop, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-		if (args.mirror): flipImage(crop,new_file,make_path)
-		if (args.rotate): rotateImage(crop,filename,make_path)
+		saveCrop(img_copy, img_copy[0:h,0:h], make_path, filename, "-wide1", 'left', scale)
+		saveCrop(img_copy, img_copy[0:h,w-h:w], make_path, filename, "-wide2", 'right', scale)
 
 	else:
-		img_copy = crop_to_square(img_copy)
-		img_copy = image_resize(img_copy, max = scale)
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-		if (args.mirror): flipImage(img_copy,new_file,make_path)
-		if(args.rotate): rotateImage(img_copy,filename,make_path)
+		saveCrop(img_copy, crop_to_square(img_copy), make_path, filename, "", 'crop_to_square', scale)
 		
 
+def tileStarts(length,tile,stride):
+	# where the tiles along one side start, the last one flush with the end
+	# when the regular ones leave enough of it out
+	starts = list(range(0, length - tile + 1, stride))
+	if starts and length - (starts[-1] + tile) >= max(args.tile_coverage * tile, 1):
+		starts.append(length - tile)
+	return starts
+
+def tileSource(img,tile):
+	# resizes img, or a bigger version of it, so that a tile of it is scale x scale
+	def resize(source, scale):
+		(h, w) = img.shape[:2]
+		r = scale / float(tile)
+		return cv2.resize(source, (max(int(round(w * r)), scale), max(int(round(h * r)), scale)), interpolation = inter)
+	return resize
+
+def makeTiles(img,filename,scale,make_path):
+	(h, w) = img.shape[:2]
+	# --tile_size is in the pixels of the file, which a reduced decode shrinks
+	tile = int(round(args.tile_size / float(REDUCED_FACTORS.get(source_flags, 1)))) if args.tile_size else min(h, w)
+	if tile < 1 or tile > min(h, w):
+		if(args.verbose): print(os.path.splitext(filename)[0] + ': smaller than a tile')
+		return
+	stride = max(int(round(args.tile_stride * tile)), 1)
+	rows = tileStarts(h, tile, stride)
+	columns = tileStarts(w, tile, stride)
+
+	if args.augment_mode == 'virtual':
+		for (i, y) in enumerate(rows):
+			for (j, x) in enumerate(columns):
+				saveCrop(img, img[y:y+tile, x:x+tile], make_path, filename, "-%d-%d" % (i, j), 'tile', scale, output_profile)
+		return
+
+	# every tile has the same scale, so the image is resized once and the
+	# tiles are views of it
+	resized = sharedResize(('tiles', tile), img, scale, tileSource(img, tile))
+	(rh, rw) = resized.shape[:2]
+	r = scale / float(tile)
+	for (i, y) in enumerate(rows):
+		y = min(int(round(y * r)), rh - scale)
+		for (j, x) in enumerate(columns):
+			x = min(int(round(x * r)), rw - scale)
+			saveCrop(resized, resized[y:y+scale, x:x+scale], make_path, filename, "-%d-%d" % (i, j), profile=output_profile)
+
 def makeSquareCropPatch(img,filename,scale):
 	make_path = args.output_folder + "sq-"+str(scale)+"/"
-	if not os.path.exists(make_path):
-		os.makedirs(make_path)
-
-	img_copy = img.copy()
-	img_copy = crop_square_patch(img_copy,args.max_size)
+	makeDir(make_path)
 
-	new_file = os.path.splitext(filename)[0] + ".png"
-	cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-
-	if (args.mirror): flipImage(img_copy,new_file,make_path)
-	if (args.rotate): rotateImage(img_copy,new_file,make_path)
+	saveCrop(img, crop_square_patch(img,scale), make_path, filename)
 
 def makePix2Pix(img,filename,scale,direction="BtoA",value=[0,0,0]):
-	img_p2p = img.copy()
-	img_p2p = image_resize(img_p2p, max = scale)
+	img_p2p = sharedResize('full', img, scale)
 	(h, w) = img_p2p.shape[:2]
 	bType = cv2.BORDER_CONSTANT
 	
 	make_path = args.output_folder + "pix2pix-"+str(h)+"/"
-	if not os.path.exists(make_path):
-		os.makedirs(make_path)
+	makeDir(make_path)
 
-	canny = cv2.cvtColor(processCanny(img_p2p),cv2.COLOR_GRAY2RGB)
+	canny = cv2.cvtColor(sharedCanny(img, scale),cv2.COLOR_GRAY2RGB)
 	
 	if(direction=="BtoA"):
 		img_p2p = cv2.copyMakeBorder(img_p2p, 0, 0, w, 0, bType, None, value)
 		img_p2p[0:h,0:w] = canny
 	
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(make_path, new_file), img_p2p, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(make_path, new_file), img_p2p, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-def flipImage(img,filename,path):
-	flip_img = cv2.flip(img, 1)
-	flip_file = os.path.splitext(filename)[0] + "-flipped.png"
-	cv2.imwrite(os.path.join(path, flip_file), flip_img, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-
-def rotateImage(img,filename,path):
-	r = img.copy() 
-	r = imutils.rotate_bound(r, 90)
-
-	if(args.file_extension == "png"):
-		r_file = os.path.splitext(filename)[0] + "-rot90.png"
-		cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		r_file = os.path.splitext(filename)[0] + "-rot90.jpg"
-		cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-	r = imutils.rotate_bound(r, 90)
-	if(args.file_extension == "png"):
-		r_file = os.path.splitext(filename)[0] + "-rot180.png"
-		cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		r_file = os.path.splitext(filename)[0] + "-rot180.jpg"
-		cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-	r = imutils.rotate_bound(r, 90)
-	if(args.file_extension == "png"):
-		r_file = os.path.splitext(filename)[0] + "-rot270.png"
-		cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		r_file = os.path.splitext(filename)[0] + "-rot270.jpg"
-		cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-def processImage(img,filename):
-
-	if args.process_type == "resize":	
-		makeResize(img,filename,args.max_size)
-	if args.process_type == 'resize_to_rectangle':
-		makeResizeToRectangle(img,filename,args.width,args.height,args.allow_rotating)
-	if args.process_type == "resize_pad":	
-		makeResizePad(img,filename,args.max_size)
-	if args.process_type == "square":
-		makeSquare(img,filename,args.max_size)
-	if args.process_type == "crop_to_square":
-		makeSquareCrop(img,filename,args.max_size)
-	if args.process_type == "crop_center_square":
-		makeCropCenterSquare(img,filename,args.max_size)
-	if args.process_type == "canny":
-		makeCanny(img,filename,args.max_size)
-	if args.process_type == "canny-pix2pix":
-		makePix2Pix(img,filename,args.max_size)
-	if args.process_type == "crop_square_patch":
-		makeSquareCropPatch(img,filename,args.max_size)
-	if args.process_type == "scale":
-		makeScale(img,filename,args.scale)
-	if args.process_type == "many_squares":
-		makeManySquares(img,filename,args.max_size)
-	if args.process_type == "crop":
-		makeCrop(img,filename)
-	if args.process_type == "distance":
-		makeDistance(img,filename,args.max_size)
-
-def main():
-	global args
-	global count
-	global inter
-	args = parse_args()
+	new_file = saveImage(img_p2p, make_path, filename)
+
+def outputName(path,new_file):
+	# relative to the output folder, like the tar members
+	return os.path.relpath(os.path.join(path, new_file), args.output_folder)
+
+def augmentImage(img,filename,path,profile=None):
+	# the variants are written with the encoder of the run, like every other
+	# output, unless the output they vary has its own
+	if profile is None:
+		profile = output_profile
+	if args.augment_mode == 'virtual':
+		name = outputName(path, filename)
+		# the variants of a virtual crop are made from the same box
+		base = views.get(name, {'source': name, 'read': cv2.IMREAD_UNCHANGED})
+		for variant in args.augment:
+			view = dict(base)
+			view['name'] = outputName(path, os.path.splitext(filename)[0] + '-' + variant + profile.extension)
+			view['variant'] = variant
+			views[view['name']] = view
+		return
+
+	with profiler.stage('augmentImage'):
+		for suffix, variant in augment.augment(img, args.augment):
+			saveImage(variant, path, filename, suffix, profile)
+
+def viewOffset(img,view):
+	# where a slice of img starts in it, as (x, y)
+	offset = view.__array_interface__['data'][0] - img.__array_interface__['data'][0]
+	(y, rest) = divmod(offset, img.strides[0])
+	return rest // img.strides[1], y
+
+def saveCrop(img,crop,path,filename,suffix="",key=None,scale=None,profile=None):
+	# a crop of the decoded input, resized to scale x scale when key is given,
+	# and its variants; --augment_mode virtual records the box instead
+	if profile is None:
+		profile = png_profile
+	if args.augment_mode == 'virtual':
+		new_file = os.path.splitext(filename)[0] + suffix + profile.extension
+		(x, y) = viewOffset(img, crop)
+		(h, w) = crop.shape[:2]
+		view = {'name': outputName(path, new_file), 'source': os.path.relpath(source_path, args.output_folder), 'read': source_flags, 'box': [x, y, w, h]}
+		if key is not None:
+			view['size'] = [scale, scale]
+		views[view['name']] = view
+	else:
+		if key is not None:
+			crop = sharedResize(key, crop, scale)
+		new_file = saveImage(crop, path, filename, suffix, profile)
+	augmentImage(crop,new_file,path)
+
+def processImage(img,filename,process_types):
+	global shared
+	shared = {}
+
+	if 'resize_to_rectangle' in process_types:
+		with profiler.stage('makeResizeToRectangle'): makeResizeToRectangle(img,filename,args.width,args.height,args.allow_rotating)
+	if "scale" in process_types:
+		with profiler.stage('makeScale'): makeScale(img,filename,args.scale)
+	if "crop" in process_types:
+		with profiler.stage('makeCrop'): makeCrop(img,filename)
+
+	# largest first, so every size is resized from the one before it
+	for size in sorted(args.max_size, reverse=True):
+		if "resize" in process_types:	
+			with profiler.stage('makeResize'): makeResize(img,filename,size)
+		if "resize_pad" in process_types:	
+			with profiler.stage('makeResizePad'): makeResizePad(img,filename,size)
+		if "square" in process_types:
+			with profiler.stage('makeSquare'): makeSquare(img,filename,size)
+		if "crop_to_square" in process_types:
+			with profiler.stage('makeSquareCrop'): makeSquareCrop(img,filename,size)
+		if "crop_center_square" in process_types:
+			with profiler.stage('makeCropCenterSquare'): makeCropCenterSquare(img,filename,size)
+		if "canny" in process_types:
+			with profiler.stage('makeCanny'): makeCanny(img,filename,size)
+		if "canny-pix2pix" in process_types:
+			with profiler.stage('makePix2Pix'): makePix2Pix(img,filename,size)
+		if "crop_square_patch" in process_types:
+			with profiler.stage('makeSquareCropPatch'): makeSquareCropPatch(img,filename,size)
+		if "many_squares" in process_types:
+			with profiler.stage('makeManySquares'): makeManySquares(img,filename,size)
+		if "distance" in process_types:
+			with profiler.stage('makeDistance'): makeDistance(img,filename,size)
+
+# JPEG DCT scaling: libjpeg decodes straight to 1/2, 1/4 or 1/8 size
+REDUCED_COLOR = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+REDUCED_FACTORS = dict((flags, factor) for factor, flags in REDUCED_COLOR.items())
+
+def fitsTarget(w,h,factor,process_types):
+	# True when an image of w x h still has enough pixels for every process
+	# type, i.e. it goes through the same steps and is never enlarged
+	for process_type in process_types:
+		if process_type in ["resize","square","canny","canny-pix2pix","distance"]:
+			if max(w, h) < max(args.max_size):
+				return False
+		elif process_type == "many_squares" and args.many_squares_mode == 'tiles' and args.tile_size:
+			if args.tile_size // factor < max(args.max_size):
+				return False
+		elif process_type in ["crop_to_square","crop_center_square","many_squares"]:
+			if min(w, h) < max(args.max_size):
+				return False
+		elif process_type == "resize_to_rectangle":
+			(rw, rh) = (h, w) if args.allow_rotating and h > w else (w, h)
+			if rw < args.width or rh < args.height:
+				return False
+		else:
+			# crop, crop_square_patch and scale work on the original pixels
+			return False
+	return True
+
+def readFlags(info,process_types):
+	if info is not None and info[0] == 'jpeg':
+		(w, h) = info[1:]
+		for factor in [8, 4, 2]:
+			if fitsTarget(-(-w // factor), -(-h // factor), factor, process_types):
+				return REDUCED_COLOR[factor]
+
+	return cv2.IMREAD_COLOR
+
+def decodeGroups(file_path):
+	# every process type gets the decode it would get on its own, so adding
+	# one to a run never changes the pixels of another; the ones that agree
+	# share a decode, which is all of them unless crop, crop_square_patch or
+	# scale (always full size) are mixed with types that can use less
+	info = None if args.exact_decode else image_info(file_path)
+	groups = {}
+	for process_type in args.process_type:
+		groups.setdefault(readFlags(info, [process_type]), []).append(process_type)
+	return groups.items()
+
+def processFile(file_path,filename,index):
+	# returns the outputs and the writes still in flight for them
+	global written
+	global writes
+	global image_index
+	global source_path
+	global source_flags
+	global views
+	written = []
+	writes = []
+	# the images of --augment_mode virtual, by output name
+	views = {}
+	image_index = index
+	source_path = file_path
+	with profiler.stage('probe'):
+		groups = decodeGroups(file_path)
+	decoded = True
+	for source_flags, process_types in groups:
+		with profiler.stage('read'):
+			img = cv2.imread(file_path, source_flags)
+		profiler.count_file('read', file_path)
+
+		decoded = hasattr(img, 'copy')
+		if not decoded:
+			if(args.verbose): print('could not read image: ' + file_path)
+			break
+		if(args.verbose): print('processing image: ' + filename)
+		processImage(img,filename,process_types)
+	if views:
+		written.append(os.path.join(args.output_folder, VIRTUAL_INDEX))
+		if virtuals is not None:
+			virtuals.add(views.values())
+	profiler.image_done()
+	return written, writes, decoded
+
+def processFileAndWait(file_path,filename,index):
+	outputs, futures, decoded = processFile(file_path, filename, index)
+	outputs = outputs + [future.result() for future in futures]
+	# tar members, filled array rows and the encode totals of this process
+	# travel back with the outputs
+	members = shards.take() if shards is not None else []
+	filled = arrays.take() if arrays is not None else []
+	return [output for output in outputs if output], decoded, members, filled, list(views.values()), output_profiles.stats.take(), profiler.take()
+
+def finishFile(manifest,file_path,filename,stamp,outputs,futures,decoded):
+	# raises if one of the writes failed, so it never ends up in the manifest
+	outputs = outputs + [future.result() for future in futures]
+	manifest.record(file_path, filename, stamp, outputs)
+	progress.update(bytes_in=stamp[0], error=not decoded)
+
+def finishWorkerFile(manifest,file_path,filename,stamp,result):
+	(outputs, decoded, members, filled, added, totals, profile) = result
+	with profiler.stage('write'):
+		outputs = outputs + [shards.add(name, data) for name, data in members]
+	if arrays is not None:
+		arrays.merge(filled)
+	if added:
+		virtuals.add(added)
+	output_profiles.stats.merge(totals)
+	profiler.merge(profile)
+	manifest.record(file_path, filename, stamp, outputs)
+	progress.update(bytes_in=stamp[0], error=not decoded)
+
+def listImages():
 	count = int(0)
-	inter = cv2.INTER_CUBIC
-	os.environ['OPENCV_IO_ENABLE_JASPER']= "true"
-
-	for root, subdirs, files in os.walk(args.input_folder):
+	for root, subdirs, files in profiler.iterate('list', walk_images(args.input_folder)):
 		if(args.verbose): print('--\nroot = ' + root)
 
 		for subdir in subdirs:
@@ -682,16 +1036,169 @@ def main():
 		for filename in files:
 			file_path = os.path.join(root, filename)
 			if(args.verbose): print('\t- file %s (full path: %s)' % (filename, file_path))
-			
-			img = cv2.imread(file_path)
-
-			if hasattr(img, 'copy'):
-				print('processing image: ' + filename)
-				if args.name:
-					processImage(img,filename)
-				else:
-					processImage(img,str(count))
-				count = count + int(1)
+
+			# numbers are handed out here, before decoding, so that --numbered
+			# names do not depend on which worker finishes first; an image that
+			# then fails to decode leaves a gap
+			if args.name:
+				yield file_path, filename, count
+			else:
+				yield file_path, str(count), count
+			count = count + int(1)
+
+def startWriter():
+	global writer
+	writer = None
+	if args.writer_threads > 0:
+		writer = ImageWriter(args.writer_threads, args.write_queue)
+
+def startShards():
+	global shards
+	shards = None
+	if args.output_format == 'tar':
+		shards = ShardWriter(args.output_folder, parse_size(args.shard_size))
+
+def startArrays(images=None):
+	# images is the number of inputs in the main process, which creates the arrays
+	global arrays
+	global variants
+	variants = [""] + augment.suffixes(args.augment)
+
+	arrays = None
+	if args.output_format == 'npy':
+		arrays = ArrayWriter(args.output_folder)
+		if images is not None:
+			for size in args.max_size:
+				names = []
+				if set(args.process_type) & set(["square","crop_to_square","crop_square_patch"]):
+					names.append("sq-"+str(size))
+				if "crop_center_square" in args.process_type:
+					names.append("crop-center-square-"+str(size))
+				for name in names:
+					arrays.create(name, images * len(variants), (size, size, 3))
+
+def startVirtual():
+	global virtuals
+	virtuals = None
+	if args.augment_mode == 'virtual':
+		virtuals = VirtualIndex(args.output_folder)
+
+def initWorker(worker_args):
+	global args
+	global inter
+	global made_dirs
+	global shards
+	global virtuals
+	args = worker_args
+	if args.profile:
+		profiler.enable()
+	inter = cv2.INTER_CUBIC
+	made_dirs = set()
+	shards = ShardBuffer() if args.output_format == 'tar' else None
+	# the main process writes the records the workers send back
+	virtuals = None
+	startArrays()
+	setupProfiles()
+	startWriter()
+	# one OpenCV thread per process, otherwise the pool oversubscribes the cores
+	cv2.setNumThreads(1)
+
+# arguments that do not change what gets written
+RUN_ONLY_ARGS = ['verbose','input_folder','output_folder','force','workers','writer_threads','write_queue','shard_size','profile']
+
+def pendingImages(tasks, manifest):
+	# the arrays of --output_format npy are written from scratch every run,
+	# and so is a virtual.jsonl that has gone missing; a run that never had
+	# records never wrote one
+	lost = virtuals is not None and not virtuals.found and any(VIRTUAL_INDEX in entry['outputs'] for entry in manifest.entries.values())
+	skip = not args.force and args.output_format != 'npy' and not lost
+	for file_path, filename, index in tasks:
+		with profiler.stage('manifest'):
+			stamp = manifest.stamp(file_path)
+			done = skip and manifest.done(file_path, filename, stamp)
+		if done:
+			if(args.verbose): print('skipping unchanged image: ' + file_path)
+			progress.update(skipped=True)
+			continue
+		yield file_path, filename, stamp, index
+
+def runWorkers(tasks, manifest):
+	workers = args.workers if args.workers > 0 else os.cpu_count()
+	# keep only a few images per worker queued up, so huge folders do not pile up in memory
+	max_pending = workers * 4
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(args,)) as pool:
+		pending = {}
+		for file_path, filename, stamp, index in tasks:
+			if len(pending) >= max_pending:
+				done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					finishWorkerFile(manifest, *pending.pop(future), future.result())
+			pending[pool.submit(processFileAndWait, file_path, filename, index)] = (file_path, filename, stamp)
+
+		for future in concurrent.futures.as_completed(pending):
+			finishWorkerFile(manifest, *pending[future], future.result())
+
+def main():
+	global args
+	global inter
+	global made_dirs
+	global progress
+	args = parse_args()
+	if args.profile:
+		profiler.enable()
+	inter = cv2.INTER_CUBIC
+	made_dirs = set()
+	os.environ['OPENCV_IO_ENABLE_JASPER']= "true"
+	setupProfiles()
+
+	settings = dict((k, v) for k, v in vars(args).items() if k not in RUN_ONLY_ARGS)
+	manifest = Manifest(args.output_folder + "manifest.jsonl", args.input_folder, settings)
+	progress = Progress(bytes_out=output_profiles.stats.size, redraw=not args.verbose)
+	images = listImages()
+	if args.output_format == 'npy':
+		# the arrays need the number of inputs up front
+		images = list(images)
+		startArrays(len(images))
+		progress.total = len(images)
+	else:
+		startArrays()
+		progress.count(iter_images(args.input_folder, magic=False))
+	tasks = pendingImages(images, manifest)
+	startShards()
+	startVirtual()
+
+	try:
+		if args.workers == 1:
+			startWriter()
+			# files whose outputs are still being written, oldest first
+			pending = collections.deque()
+			try:
+				for file_path, filename, stamp, index in tasks:
+					pending.append((file_path, filename, stamp) + processFile(file_path, filename, index))
+					while pending and all(future.done() for future in pending[0][4]):
+						finishFile(manifest, *pending.popleft())
+				while pending:
+					finishFile(manifest, *pending.popleft())
+			finally:
+				if writer is not None:
+					writer.close()
+		else:
+			runWorkers(tasks, manifest)
+
+		if arrays is not None:
+			arrays.close()
+	finally:
+		if shards is not None:
+			shards.close()
+			write_index(args.output_folder)
+		if virtuals is not None:
+			virtuals.close()
+		manifest.close()
+
+	progress.finish()
+	output_profiles.print_summary()
+	profiler.finish(args.output_folder + "profile-trace.json")
 
 
 if __name__ == "__main__":
@@ -5,6 +5,17 @@ import imutils
 import cv2
 import random
 import operator
+import sys
+import hashlib
+from collections import OrderedDict
+from image_probe import image_info
+from fileops import place_file, LINK_TYPES
+from shard_writer import parse_size
+import output_profiles
+from profiling import profiler
+from progress import Progress
+from image_files import walk_images, iter_images
+from output_profiles import get_profile, legacy_profile, PROFILES, FORMATS
 
 # print(cv2.__version__)
 
@@ -35,26 +46,273 @@ def parse_args():
 		default=1.0,
 		help='average pixel difference between images (use with --relative) (default: %(default)s)')
 
+	parser.add_argument('--hash', type=str,
+		default='none', choices=["none","dhash","phash"],
+		help='Index images by a perceptual hash instead of comparing every pair of images (default: %(default)s)')
+
+	parser.add_argument('--hash_distance', type=int,
+		default=4,
+		help='maximum number of differing hash bits for two images to match (use with --hash and --relative) (default: %(default)s)')
+
+	parser.add_argument('--stream', action='store_true',
+		help='Keep only image hashes in memory and reload pixels from disk to confirm matches (uses --hash, dhash by default)')
+
+	parser.add_argument('--max_memory', type=str,
+		default='2G',
+		help='memory budget for hashes and cached pixels when using --stream, e.g. 512M or 8G (default: %(default)s)')
+
+	parser.add_argument('--link_type', type=str,
+		default='hardlink', choices=LINK_TYPES,
+		help='How to place kept images that are already in the output format when using --absolute (default: %(default)s)')
+
+	parser.add_argument('--profile', action='store_true',
+		help='Time every stage of the run and print a summary; a Chrome trace is written to profile-trace.json in the output folder.')
+
+	parser.add_argument('--output_profile', type=str,
+		default=None,
+		help='Encoder settings for the kept images, NAME or NAME:LEVEL; replaces --file_extension. ' + str(sorted(PROFILES)) + ' (default: png-raw, or jpg:90 when --file_extension jpg)')
+
 	feature_parser = parser.add_mutually_exclusive_group(required=False)
 	feature_parser.add_argument('--absolute', dest='absolute', action='store_true')
 	feature_parser.add_argument('--relative', dest='absolute', action='store_false')
 	parser.set_defaults(absolute=True)
 
 	args = parser.parse_args()
+	if args.output_profile:
+		try:
+			get_profile(args.output_profile)
+		except ValueError as e:
+			parser.error('--output_profile: ' + str(e))
 	return args
 
+def dhash(img):
+	# 64 bit difference hash: is each pixel of a 9x8 thumbnail brighter than its left neighbour
+	small = cv2.resize(img, (9, 8), interpolation = cv2.INTER_AREA)
+	bits = small[:,1:] > small[:,:-1]
+	return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def phash(img):
+	# 64 bit dct hash: low frequencies of a 32x32 thumbnail compared to their median
+	small = cv2.resize(img, (32, 32), interpolation = cv2.INTER_AREA).astype(np.float32)
+	low = cv2.dct(small)[:8,:8].flatten()
+	bits = low > np.median(low[1:])
+	return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def imageHash(img):
+	with profiler.stage('hash'):
+		if img.ndim == 3:
+			img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+		if args.hash == "phash":
+			return phash(img)
+		return dhash(img)
+
+def readImage(file_path):
+	with profiler.stage('read'):
+		img = cv2.imread(file_path)
+	profiler.count_file('read', file_path)
+	return img
+
+def hamming(a,b):
+	return bin(a ^ b).count('1')
+
+class BKTree:
+	# metric tree over hamming distance; each child edge is labelled with
+	# its distance to the parent, so a radius query only visits edges
+	# within [d - radius, d + radius]
+	def __init__(self):
+		self.root = None
+
+	def add(self, h, item):
+		node = [h, item, {}]
+		if self.root is None:
+			self.root = node
+			return
+		current = self.root
+		while True:
+			d = hamming(h, current[0])
+			child = current[2].get(d)
+			if child is None:
+				current[2][d] = node
+				return
+			current = child
+
+	def find(self, h, radius):
+		found = []
+		if self.root is None:
+			return found
+		stack = [self.root]
+		while stack:
+			current = stack.pop()
+			d = hamming(h, current[0])
+			if d <= radius:
+				found.append((d, current[1]))
+			for edge, child in current[2].items():
+				if d - radius <= edge <= d + radius:
+					stack.append(child)
+		return found
+
+# rough cost of one kept image in the BK-tree: node list, child dict, hash and names
+SIGNATURE_BYTES = 512
+
+class PixelCache:
+	# least recently used decoded images, bounded by their total size
+	def __init__(self, budget):
+		self.budget = budget
+		self.size = 0
+		self.images = OrderedDict()
+
+	def get(self, file_path):
+		img = self.images.get(file_path)
+		if img is not None:
+			self.images.move_to_end(file_path)
+			return img
+		img = readImage(file_path)
+		self.put(file_path, img)
+		return img
+
+	def put(self, file_path, img):
+		if img is None or img.nbytes > self.budget or file_path in self.images:
+			return
+		self.images[file_path] = img
+		self.size += img.nbytes
+		while self.size > self.budget:
+			(_, old) = self.images.popitem(last=False)
+			self.size -= old.nbytes
+
+	def shrink(self, budget):
+		self.budget = budget
+		while self.size > self.budget and self.images:
+			(_, old) = self.images.popitem(last=False)
+			self.size -= old.nbytes
+
 def compare(img1,img2):
 	test = False
-	difference = cv2.absdiff(img1, img2)
-	if(args.absolute):	
-		return not np.any(difference)
-	else:
-		return np.divide(np.sum(difference),img1.shape[0]*img1.shape[1]) <= args.avg_match
+	# images of different sizes can not be pixel duplicates (and absdiff would fail)
+	if img1.shape != img2.shape:
+		return False
+	with profiler.stage('compare'):
+		difference = cv2.absdiff(img1, img2)
+		if(args.absolute):	
+			return not np.any(difference)
+		else:
+			return np.divide(np.sum(difference),img1.shape[0]*img1.shape[1]) <= args.avg_match
 
 		#way too greedy
 		#return np.allclose(img1,img2,2,2)
 
 
+def saveImage(img,path,filename):
+	output_profiles.save(img, path, os.path.splitext(filename)[0], output_profile)
+
+def saveFile(file_path,fmt,img,path,filename):
+	if fmt == FORMATS[output_profile.extension]:
+		# nothing to convert, keep the original bytes
+		new_file = os.path.splitext(filename)[0] + output_profile.extension
+		with profiler.stage('place_file'): place_file(file_path, os.path.join(path, new_file), args.link_type)
+		return
+	if img is None:
+		img = readImage(file_path)
+	saveImage(img,path,filename)
+
+def startProgress(total=None):
+	return Progress(total, output_profiles.stats.size, not args.verbose)
+
+def fileDigest(file_path):
+	digest = hashlib.blake2b(digest_size=16)
+	with profiler.stage('digest'):
+		with open(file_path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20), b''):
+				digest.update(chunk)
+	profiler.count_file('digest', file_path)
+	return digest.digest()
+
+def pixelDigest(img):
+	digest = hashlib.blake2b(digest_size=16)
+	with profiler.stage('digest'):
+		digest.update(str(img.shape).encode())
+		digest.update(np.ascontiguousarray(img).data)
+	return digest.digest()
+
+def excludeExact(files):
+	path = args.output_folder + "exclude/"
+	if not os.path.exists(path):
+		os.makedirs(path)
+
+	print("processing...")
+	print("total images: " + str(len(files)))
+
+	# level 1: byte-identical files. Only files sharing a size get read and
+	# hashed, and none of them get decoded.
+	sizes = {}
+	by_size = {}
+	for filename, file_path in files:
+		sizes[file_path] = os.path.getsize(file_path)
+		by_size[sizes[file_path]] = by_size.get(sizes[file_path], 0) + 1
+
+	first_copy = {}
+	duplicate_of = {}
+	for filename, file_path in files:
+		if by_size[sizes[file_path]] < 2:
+			continue
+		key = (sizes[file_path], fileDigest(file_path))
+		if key in first_copy:
+			duplicate_of[file_path] = first_copy[key]
+		else:
+			first_copy[key] = (filename, file_path)
+
+	# level 2: the same pixels in a different container or with different
+	# metadata. Only images whose header size is shared with another image
+	# can match, so the rest are never decoded for this. Formats whose
+	# header can not be read are decoded here to find their size.
+	infos = {}
+	dims = {}
+	digests = {}
+	by_dims = {}
+	for filename, file_path in files:
+		if file_path in duplicate_of:
+			continue
+		with profiler.stage('probe'): info = image_info(file_path)
+		infos[file_path] = info
+		if info is not None:
+			dims[file_path] = info[1:]
+		else:
+			img = readImage(file_path)
+			if not hasattr(img, 'copy'):
+				continue
+			dims[file_path] = (img.shape[1], img.shape[0])
+			digests[file_path] = pixelDigest(img)
+		by_dims[dims[file_path]] = by_dims.get(dims[file_path], 0) + 1
+
+	seen = {}
+	progress = startProgress(len(files))
+	for filename, file_path in files:
+		progress.update(bytes_in=sizes[file_path])
+		if file_path in duplicate_of:
+			print (duplicate_of[file_path][0] + " matches " + filename)
+			continue
+
+		if file_path not in dims:
+			# could not be decoded
+			continue
+		info = infos[file_path]
+		fmt = info[0] if info is not None else None
+		img = None
+		if by_dims[dims[file_path]] > 1:
+			if file_path in digests:
+				key = digests[file_path]
+			else:
+				img = readImage(file_path)
+				if not hasattr(img, 'copy'):
+					continue
+				key = pixelDigest(img)
+			if key in seen:
+				print (seen[key] + " matches " + filename)
+				continue
+			seen[key] = filename
+
+		saveFile(file_path,fmt,img,path,filename)
+	progress.finish()
+
 def exclude(imgs,filenames):
 	path = args.output_folder + "exclude/"
 	if not os.path.exists(path):
@@ -65,13 +323,16 @@ def exclude(imgs,filenames):
 	print("processing...")
 	print("total images: " + str(len(imgs)))
 
+	progress = startProgress(len(imgs))
 	while i < len(imgs):
 		img = imgs[i][0]
 		filename = imgs[i][1]
 
-		print("matching to: " + filename)
-		print( str(i) + "/" + str(len(imgs)) )
+		if(args.verbose): print("matching to: " + filename)
+		if(args.verbose): print( str(i) + "/" + str(len(imgs)) )
 
+		remaining = len(imgs)
+		size = imgs[i][2]
 		i2 = i+1
 		while i2 < len(imgs):
 			popped = False
@@ -82,22 +343,102 @@ def exclude(imgs,filenames):
 			if compare(img,img2):
 				print (filename + " matches " + filename2)
 				popped = True
-				imgs.pop(i2)
+				size += imgs.pop(i2)[2]
 
 			if not popped:
 				i2 += 1
 
-		if(args.file_extension == "png"):
-			new_file = os.path.splitext(filename)[0] + ".png"
-			cv2.imwrite(os.path.join(path, new_file), img, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-		else:
-			new_file = os.path.splitext(filename)[0] + ".jpg"
-			cv2.imwrite(os.path.join(path, new_file), img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+		saveImage(img,path,filename)
+		# the duplicates that were just dropped are done too
+		progress.update(images=1 + remaining - len(imgs), bytes_in=size)
 
 		i += 1
+	progress.finish()
+
+def excludeHashed(imgs):
+	path = args.output_folder + "exclude/"
+	if not os.path.exists(path):
+		os.makedirs(path)
+
+	# an image is a duplicate when an earlier kept image is within the radius,
+	# the same images the pairwise exclude() keeps, without comparing every pair
+	radius = 0 if args.absolute else args.hash_distance
+	print("processing...")
+	print("total images: " + str(len(imgs)))
+
+	kept = BKTree()
+	progress = startProgress(len(imgs))
+	for i, (img, filename, size) in enumerate(imgs):
+		if(args.verbose): print( str(i) + "/" + str(len(imgs)) )
+		progress.update(bytes_in=size)
+		h = imageHash(img)
+
+		matches = sorted(kept.find(h, radius), key=operator.itemgetter(0))
+		if args.absolute:
+			# equal hashes are only candidates, the pixels decide
+			matches = [m for m in matches if compare(m[1][0], img)]
+
+		if matches:
+			print (matches[0][1][1] + " matches " + filename)
+		else:
+			kept.add(h, (img, filename))
+			saveImage(img,path,filename)
+	progress.finish()
+
 
 
 
+def excludeStreaming(files):
+	path = args.output_folder + "exclude/"
+	if not os.path.exists(path):
+		os.makedirs(path)
+
+	budget = parse_size(args.max_memory)
+	# worst case every image is kept; fail now rather than after hours of work
+	if len(files) * SIGNATURE_BYTES > budget:
+		sys.exit("--max_memory %s is too small for the hashes of %d images" % (args.max_memory, len(files)))
+
+	radius = 0 if args.absolute else args.hash_distance
+	print("processing...")
+	print("total images: " + str(len(files)))
+
+	kept = BKTree()
+	count = 0
+	cache = PixelCache(budget)
+	progress = startProgress(len(files))
+	for i, (filename, file_path) in enumerate(files):
+		if(args.verbose): print( str(i) + "/" + str(len(files)) )
+		img = readImage(file_path)
+		if not hasattr(img, 'copy'):
+			progress.update(error=True)
+			continue
+		progress.update(bytes_in=os.path.getsize(file_path))
+
+		# the hashes share the budget with the pixel cache
+		cache.shrink(budget - count * SIGNATURE_BYTES - img.nbytes)
+
+		h = imageHash(img)
+		match = None
+		# the same rule as excludeHashed: the hash radius decides, and with
+		# --absolute only the pixels of an equal hash do
+		for d, (filename2, file_path2, shape2) in sorted(kept.find(h, radius), key=operator.itemgetter(0)):
+			if not args.absolute:
+				match = filename2
+				break
+			if shape2 != img.shape:
+				continue
+			if compare(cache.get(file_path2), img):
+				match = filename2
+				break
+
+		if match is not None:
+			print (match + " matches " + filename)
+		else:
+			kept.add(h, (filename, file_path, img.shape))
+			count += 1
+			cache.put(file_path, img)
+			saveImage(img,path,filename)
+	progress.finish()
 
 def sort(imgs):
 	#TODO
@@ -134,7 +475,9 @@ def sort(imgs):
 	# 	cv2.imwrite(os.path.join(path, new_file), img, [cv2.IMWRITE_JPEG_QUALITY, 90])
 
 def processImage(imgs,filenames):
-	if args.process_type == "exclude":	
+	if args.process_type == "exclude" and args.hash != "none":
+		excludeHashed(imgs)
+	elif args.process_type == "exclude":	
 		exclude(imgs,filenames)
 	if args.process_type == "sort":	
 		sort(imgs,filenames)
@@ -143,33 +486,69 @@ def main():
 	global args
 	global count
 	global inter
+	global output_profile
 	args = parse_args()
+	if args.profile:
+		profiler.enable()
+	if args.output_profile:
+		output_profile = get_profile(args.output_profile)
+	else:
+		output_profile = legacy_profile(args.file_extension)
 	count = int(0)
 	inter = cv2.INTER_CUBIC
 	os.environ['OPENCV_IO_ENABLE_JASPER']= "true"
 
 	imgs = []
 	filenames = []
+	image_files = []
+	if args.stream and args.hash == "none":
+		args.hash = "dhash"
+	# exact matches do not need the pixels of the whole dataset either
+	exact = args.process_type == "exclude" and args.absolute and args.hash == "none"
 	print("loading images...")
-	for root, subdirs, files in os.walk(args.input_folder):
+	progress = startProgress()
+	if not (args.stream or exact):
+		progress.count(iter_images(args.input_folder, magic=False))
+	for root, subdirs, files in profiler.iterate('list', walk_images(args.input_folder)):
 		if(args.verbose): print('--\nroot = ' + root)
 
 		for subdir in subdirs:
 			if(args.verbose): print('\t- subdirectory ' + subdir)
 
 		for filename in files:
-			if not filename.startswith('.'):
-				file_path = os.path.join(root, filename)
-				if(args.verbose): print('\t- file %s (full path: %s)' % (filename, file_path))
-				
-				imgs.append([cv2.imread(file_path),filename])
-				# print(imgs)
-
+			file_path = os.path.join(root, filename)
+			if(args.verbose): print('\t- file %s (full path: %s)' % (filename, file_path))
+			
+			if args.stream or exact:
+				# only the path for now, pixels are read one image at a time
+				image_files.append((filename, file_path))
+				continue
+
+			img = readImage(file_path)
+			if hasattr(img, 'copy'):
+				# the file size goes along for the progress line of the exclude pass
+				imgs.append([img,filename,os.path.getsize(file_path)])
+				progress.update(bytes_in=imgs[-1][2])
+			else:
+				progress.update(error=True)
+			# print(imgs)
+
+	if not (args.stream or exact):
+		progress.finish()
 	print("sorting images...")
-	imgs.sort(key=operator.itemgetter(1))	
-	# for n in range(4):
-	# 	print(imgs[n][1])		
-	processImage(imgs,filenames)
+	if exact:
+		image_files.sort(key=operator.itemgetter(0))
+		excludeExact(image_files)
+	elif args.stream:
+		image_files.sort(key=operator.itemgetter(0))
+		excludeStreaming(image_files)
+	else:
+		imgs.sort(key=operator.itemgetter(1))	
+		# for n in range(4):
+		# 	print(imgs[n][1])		
+		processImage(imgs,filenames)
+	output_profiles.print_summary()
+	profiler.finish(args.output_folder + "profile-trace.json")
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
 import argparse
 import numpy as np
-import scipy.ndimage as pyimg
 import os
-import imutils
 import cv2
+from image_probe import image_size
+from profiling import profiler
+from image_files import walk_images
 import random
 import math
 
@@ -38,6 +39,9 @@ def parse_args():
         default=0,
         help='Forgive offset lower than target width and height. (default: %(default)s)')
 
+    parser.add_argument('--profile', action='store_true',
+        help='Time every stage of the run and print a summary; a Chrome trace is written to profile-trace.json in the current folder.')
+
     parser.set_defaults(name=True)
 
     args = parser.parse_args()
@@ -48,13 +52,15 @@ def main():
     global count
     global inter
     args = parse_args()
+    if args.profile:
+        profiler.enable()
     count = int(0)
     inter = cv2.INTER_CUBIC
     os.environ['OPENCV_IO_ENABLE_JASPER']= "true"
 
     base_dir = ''
 
-    for root, subdirs, files in os.walk(args.input_folder):
+    for root, subdirs, files in profiler.iterate('list', walk_images(args.input_folder)):
         if(args.verbose): print('--\nroot = ' + root)
 
         if len(subdirs) > 0:
@@ -72,14 +78,14 @@ def main():
             file_path = os.path.join(root, filename)
             if(args.verbose): print('\t- file %s (full path: %s)' % (filename, file_path))
             
-            img = cv2.imread(file_path)
+            # only the header is read for the common formats, no decoding
+            with profiler.stage('probe'): size = image_size(file_path)
 
-            if hasattr(img, 'copy'):
+            if size is not None:
                 # print('processing image: ' + filename)
-                (h, w) = img.shape[:2]
+                (w, h) = size
                 if w < h and args.consider_rotating:
-                    img = imutils.rotate_bound(img, 90)
-                    (h, w) = img.shape[:2]
+                    (h, w) = (w, h)
 
                 if w < args.width - args.offset or h < args.height - args.offset:
                     to_be_removed = True
@@ -88,11 +94,12 @@ def main():
                 if to_be_removed:
                     if not args.dry:
                         print('removing image: ' + file_path)
-                        os.remove(file_path)    
+                        with profiler.stage('remove'): os.remove(file_path)
                     else:
                         print('image to remove would be: ' + file_path)
                 
     print('Counted {} images marked to be removed'.format(count))
+    profiler.finish("profile-trace.json")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,56 @@
+import numpy as np
+import cv2
+
+# Distance fields for --process_type distance: the first channel is
+# thresholded at 127, then the distance of every light pixel to the nearest
+# dark one goes into green and the distance of every dark pixel to the
+# nearest light one into blue, both cut off at a clamp.
+#
+# opencv is OpenCV's exact euclidean transform and gives the same image as
+# scipy; opencv-mask5 and opencv-mask3 approximate it with 5x5 and 3x3
+# masks, off by a few levels but several times faster again. scipy is only
+# imported when it is asked for. With a scale below 1 the fields are worked
+# out on a smaller mask and resized back, which is faster still but blurs
+# the field near the edges; benchmark.py shows how far each choice is from
+# scipy.
+
+BACKENDS = ['opencv','opencv-mask5','opencv-mask3','scipy']
+
+MASKS = {'opencv': cv2.DIST_MASK_PRECISE, 'opencv-mask5': cv2.DIST_MASK_5, 'opencv-mask3': cv2.DIST_MASK_3}
+
+def distance_field(mask, backend='opencv'):
+	# float32 distance of every non-zero pixel of a uint8 mask to the nearest zero one
+	if backend == 'scipy':
+		import scipy.ndimage
+		return scipy.ndimage.distance_transform_edt(mask).astype(np.float32)
+	return cv2.distanceTransform(mask, cv2.DIST_L2, MASKS[backend])
+
+def clamped(field, clamp):
+	# the integer part, like the float to uint8 cast of the scipy version
+	np.minimum(field, clamp, out=field)
+	return field.astype(np.uint8)
+
+def distance_image(img, backend='opencv', clamps=(32, 200), scale=1.0):
+	# writes the fields into the green and blue channels of img and returns it
+	light = (img[:,:,0] > 127).astype(np.uint8)
+	dark = 1 - light
+
+	(h, w) = light.shape
+	if scale < 1.0:
+		size = (max(int(w * scale), 1), max(int(h * scale), 1))
+		# the distances of the small mask are in small pixels
+		factor = w / float(size[0])
+		fields = []
+		for mask in (light, dark):
+			small = cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+			field = distance_field(small, backend) * factor
+			field = cv2.resize(field, (w, h), interpolation=cv2.INTER_LINEAR)
+			# the resize spreads distances over the edge, pixels on the other side stay 0
+			field[mask == 0] = 0
+			fields.append(field)
+	else:
+		fields = [distance_field(light, backend), distance_field(dark, backend)]
+
+	img[:,:,1] = clamped(fields[0], clamps[0])
+	img[:,:,0] = clamped(fields[1], clamps[1])
+	return img
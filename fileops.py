@@ -0,0 +1,58 @@
+import os
+import shutil
+
+try:
+	import fcntl
+except ImportError:
+	# windows
+	fcntl = None
+
+# Puts an existing file at a new path without decoding or re-encoding it.
+
+LINK_TYPES = ["hardlink","reflink","symlink","rename","copy"]
+
+# linux/fs.h FICLONE, shares the extents on btrfs/xfs instead of copying them
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+	if fcntl is None:
+		raise OSError('reflinks are not supported on this platform')
+	with open(src, 'rb') as s, open(dst, 'wb') as d:
+		fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+def place_file(src, dst, link_type='hardlink'):
+	if link_type not in LINK_TYPES:
+		raise ValueError('unknown link type: ' + link_type)
+
+	# already there, e.g. the output folder is inside the input folder;
+	# removing dst would remove the only copy
+	if os.path.exists(dst) and os.path.samefile(src, dst):
+		return
+
+	# the writers this replaces always overwrote their output
+	if os.path.lexists(dst):
+		os.remove(dst)
+
+	if link_type == 'hardlink':
+		try:
+			os.link(src, dst)
+			return
+		except OSError:
+			# different filesystem or no hardlink support
+			pass
+	elif link_type == 'reflink':
+		try:
+			reflink(src, dst)
+			return
+		except OSError:
+			# filesystem cannot share extents, a plain copy is the closest thing
+			if os.path.exists(dst):
+				os.remove(dst)
+	elif link_type == 'symlink':
+		os.symlink(os.path.abspath(src), dst)
+		return
+	elif link_type == 'rename':
+		shutil.move(src, dst)
+		return
+
+	shutil.copyfile(src, dst)
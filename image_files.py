@@ -0,0 +1,118 @@
+import os
+import collections
+import concurrent.futures
+
+# Lists the images under a folder for every script, in place of os.walk plus
+# a failed cv2.imread for each sidecar file.
+#
+# Folders are read with os.scandir, which gets the file type with the name,
+# and a few folders ahead are listed by a pool of threads, which hides the
+# latency of network mounts. walk_images() still yields folder by folder in the
+# order os.walk would (top-down, in directory order), as soon as each one is
+# listed, so the scripts start processing before the tree is known.
+#
+# Dotfiles (.DS_Store, ._ resource forks, the temporary files of an
+# interrupted run) and files without an image extension are left out
+# without opening them; with magic, so are files whose first bytes are not
+# those of their image format.
+
+THREADS = 8
+# folders listed ahead of the one being processed
+PREFETCH = 64
+
+# what OpenCV can read
+IMAGE_EXTENSIONS = set(['.bmp', '.dib', '.jpg', '.jpeg', '.jpe', '.jp2', '.png', '.webp', '.avif',
+	'.pbm', '.pgm', '.ppm', '.pxm', '.pnm', '.pfm', '.sr', '.ras', '.tif', '.tiff', '.exr', '.hdr', '.pic', '.gif'])
+
+# the first bytes of a file of each format; formats not listed are not checked
+MAGIC = {
+	'.png': [b'\x89PNG\r\n\x1a\n'],
+	'.jpg': [b'\xff\xd8\xff'],
+	'.jpeg': [b'\xff\xd8\xff'],
+	'.jpe': [b'\xff\xd8\xff'],
+	'.gif': [b'GIF87a', b'GIF89a'],
+	'.bmp': [b'BM'],
+	'.dib': [b'BM'],
+	'.tif': [b'II*\x00', b'MM\x00*'],
+	'.tiff': [b'II*\x00', b'MM\x00*'],
+	'.jp2': [b'\x00\x00\x00\x0cjP  \r\n\x87\n', b'\xff\x4f\xff\x51'],
+	'.exr': [b'\x76\x2f\x31\x01'],
+	'.ras': [b'\x59\xa6\x6a\x95'],
+	'.sr': [b'\x59\xa6\x6a\x95'],
+	'.hdr': [b'#?RADIANCE', b'#?RGBE'],
+	'.pic': [b'#?RADIANCE', b'#?RGBE'],
+}
+
+def is_image_name(filename):
+	if filename.startswith('.'):
+		return False
+	return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+def has_image_magic(path):
+	extension = os.path.splitext(path)[1].lower()
+	try:
+		with open(path, 'rb') as f:
+			head = f.read(16)
+	except OSError:
+		return False
+	if extension == '.webp':
+		return head[:4] == b'RIFF' and head[8:12] == b'WEBP'
+	if extension == '.avif':
+		return head[4:8] == b'ftyp'
+	if extension in ('.pbm', '.pgm', '.ppm', '.pxm', '.pnm', '.pfm'):
+		return head[:1] == b'P'
+	return any(head.startswith(magic) for magic in MAGIC.get(extension, [b'']))
+
+def scan(path, magic):
+	# the subfolders, the ones os.walk would go into and the images of a folder
+	subdirs = []
+	walk_into = []
+	images = []
+	try:
+		with os.scandir(path) as entries:
+			for entry in entries:
+				try:
+					is_dir = entry.is_dir()
+				except OSError:
+					is_dir = False
+				if is_dir:
+					subdirs.append(entry.name)
+					if not entry.is_symlink():
+						walk_into.append(entry.name)
+				elif is_image_name(entry.name) and (not magic or has_image_magic(entry.path)):
+					images.append(entry.name)
+	except OSError:
+		# like os.walk, a folder that cannot be listed is left out
+		pass
+	return subdirs, walk_into, images
+
+def walk_images(folder, magic=True, threads=THREADS):
+	# yields (root, subdirs, images) like os.walk does (root, subdirs, files)
+	with concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='list') as pool:
+		stack = [(folder, pool.submit(scan, folder, magic))]
+		listing = collections.deque([stack[0][1]])
+		while stack:
+			(root, future) = stack.pop()
+			if future is None:
+				future = pool.submit(scan, root, magic)
+			else:
+				listing.remove(future)
+			(subdirs, walk_into, images) = future.result()
+
+			children = []
+			for name in walk_into:
+				path = os.path.join(root, name)
+				if len(listing) < PREFETCH:
+					children.append((path, pool.submit(scan, path, magic)))
+					listing.append(children[-1][1])
+				else:
+					children.append((path, None))
+			stack.extend(reversed(children))
+
+			yield root, subdirs, images
+
+def iter_images(folder, magic=True, threads=THREADS):
+	# the path of every image, streamed
+	for root, subdirs, images in walk_images(folder, magic, threads):
+		for filename in images:
+			yield os.path.join(root, filename)
@@ -0,0 +1,119 @@
+import struct
+import cv2
+
+# Reads width/height from the image header so that scripts which only need
+# the dimensions do not have to decode the pixels.
+
+# JPEG start-of-frame markers (C4, C8 and CC are DHT, JPG and DAC)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+def exif_orientation(data):
+	# data is the APP1 payload; returns the orientation tag or 1
+	if data[:6] != b'Exif\x00\x00':
+		return 1
+	tiff = data[6:]
+	if tiff[:2] == b'II':
+		endian = '<'
+	elif tiff[:2] == b'MM':
+		endian = '>'
+	else:
+		return 1
+
+	try:
+		ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+		entries = struct.unpack(endian + 'H', tiff[ifd:ifd+2])[0]
+		for i in range(entries):
+			entry = ifd + 2 + i*12
+			tag = struct.unpack(endian + 'H', tiff[entry:entry+2])[0]
+			if tag == 0x0112:
+				return struct.unpack(endian + 'H', tiff[entry+8:entry+10])[0]
+	except struct.error:
+		pass
+	return 1
+
+def jpeg_size(f):
+	f.seek(2)
+	orientation = 1
+	while True:
+		byte = f.read(1)
+		while byte and byte != b'\xff':
+			byte = f.read(1)
+		while byte == b'\xff':
+			byte = f.read(1)
+		if not byte:
+			return None
+		marker = byte[0]
+
+		# markers without a payload
+		if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+			continue
+
+		length = struct.unpack('>H', f.read(2))[0]
+		if marker in SOF_MARKERS:
+			(h, w) = struct.unpack('>xHH', f.read(5))
+			# cv2.imread applies the EXIF rotation, so report what it would return
+			if orientation in (5, 6, 7, 8):
+				(h, w) = (w, h)
+			return w, h
+		elif marker == 0xE1 and orientation == 1:
+			orientation = exif_orientation(f.read(length - 2))
+		else:
+			f.seek(length - 2, 1)
+
+def image_info(path):
+	# returns (format, width, height), or None if the header is not understood
+	try:
+		with open(path, 'rb') as f:
+			head = f.read(32)
+
+			if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+				(w, h) = struct.unpack('>II', head[16:24])
+				return 'png', w, h
+
+			if head[:2] == b'\xff\xd8':
+				size = jpeg_size(f)
+				if size is not None:
+					return 'jpeg', size[0], size[1]
+				return None
+
+			if head[:6] in (b'GIF87a', b'GIF89a'):
+				(w, h) = struct.unpack('<HH', head[6:10])
+				return 'gif', w, h
+
+			if head[:2] == b'BM':
+				header_size = struct.unpack('<I', head[14:18])[0]
+				if header_size == 12:
+					(w, h) = struct.unpack('<HH', head[18:22])
+				else:
+					(w, h) = struct.unpack('<ii', head[18:26])
+				# negative height means a top-down bitmap
+				return 'bmp', w, abs(h)
+
+			if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+				chunk = head[12:16]
+				if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+					(w, h) = struct.unpack('<HH', head[26:30])
+					return 'webp', w & 0x3FFF, h & 0x3FFF
+				if chunk == b'VP8L' and head[20:21] == b'\x2f':
+					bits = struct.unpack('<I', head[21:25])[0]
+					return 'webp', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+				if chunk == b'VP8X':
+					w = int.from_bytes(head[24:27], 'little') + 1
+					h = int.from_bytes(head[27:30], 'little') + 1
+					return 'webp', w, h
+	except (OSError, struct.error):
+		pass
+	return None
+
+def image_size(path):
+	# (width, height) from the header, falling back to a full decode for
+	# formats the header readers do not cover; None if it is not an image
+	info = image_info(path)
+	if info is not None:
+		return info[1], info[2]
+
+	img = cv2.imread(path)
+	if hasattr(img, 'copy'):
+		(h, w) = img.shape[:2]
+		return w, h
+	return None
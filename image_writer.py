@@ -0,0 +1,42 @@
+import threading
+import concurrent.futures
+
+# Runs encode/write jobs on their own threads so the next image can be read
+# and transformed while the outputs of the previous one are still being
+# encoded (cv2.imencode releases the GIL).
+#
+# At most max_pending jobs are queued or running; submit() blocks until a
+# slot frees up, which keeps the images waiting to be written from piling up
+# in memory when the disk is the bottleneck. A failed job fails its future,
+# and the first failure is raised again by the next submit() or by close(),
+# so a bad write stops the run instead of going unnoticed.
+
+class ImageWriter:
+	def __init__(self, threads=2, max_pending=32):
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='writer')
+		self.slots = threading.BoundedSemaphore(max(max_pending, threads))
+		self.error = None
+
+	def done(self, future):
+		self.slots.release()
+		if future.exception() is not None and self.error is None:
+			self.error = future.exception()
+
+	def check(self):
+		if self.error is not None:
+			raise self.error
+
+	def submit(self, fn, *args):
+		self.check()
+		self.slots.acquire()
+		try:
+			future = self.pool.submit(fn, *args)
+		except BaseException:
+			self.slots.release()
+			raise
+		future.add_done_callback(self.done)
+		return future
+
+	def close(self):
+		self.pool.shutdown(wait=True)
+		self.check()
@@ -0,0 +1,77 @@
+import os
+import json
+import hashlib
+
+# Records which inputs a run has finished, so a re-run (after a crash, or
+# after adding images) only processes new or changed inputs.
+#
+# One JSON line per input is appended once all of its outputs are on disk.
+# An input is skipped when its size and mtime, its output name and the
+# settings of the run are unchanged and its outputs still exist.
+
+def settings_key(settings):
+	text = json.dumps(settings, sort_keys=True, default=str)
+	return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+class Manifest:
+	def __init__(self, path, input_folder, settings):
+		self.path = path
+		self.folder = os.path.dirname(path) or '.'
+		self.input_folder = input_folder
+		self.key = settings_key(settings)
+		self.entries = {}
+		self.lines = 0
+
+		if os.path.exists(path):
+			with open(path) as f:
+				for line in f:
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						# a run that was killed mid-write
+						continue
+					self.entries[entry['input']] = entry
+					self.lines += 1
+
+		os.makedirs(self.folder, exist_ok=True)
+		self.file = open(path, 'a')
+
+	def stamp(self, file_path):
+		st = os.stat(file_path)
+		return [st.st_size, st.st_mtime_ns]
+
+	def done(self, file_path, name, stamp):
+		# the entry of an input that does not need processing again, else None
+		entry = self.entries.get(os.path.relpath(file_path, self.input_folder))
+		if entry is None or entry['key'] != self.key or entry['name'] != name or entry['stamp'] != stamp:
+			return None
+		for output in entry['outputs']:
+			if not os.path.exists(os.path.join(self.folder, output)):
+				return None
+		return entry
+
+	def record(self, file_path, name, stamp, outputs, image=True):
+		entry = {
+			'input': os.path.relpath(file_path, self.input_folder),
+			'stamp': stamp,
+			'key': self.key,
+			'name': name,
+			'image': image,
+			# outputs packed into the same tar shard list the shard once
+			'outputs': list(dict.fromkeys(os.path.relpath(output, self.folder) for output in outputs)),
+		}
+		self.file.write(json.dumps(entry) + '\n')
+		self.file.flush()
+		self.entries[entry['input']] = entry
+		self.lines += 1
+
+	def close(self):
+		self.file.close()
+
+		# every run appends, so rewrite the file once most lines are superseded
+		if self.lines > 2 * len(self.entries):
+			tmp_path = self.path + '.tmp'
+			with open(tmp_path, 'w') as f:
+				for entry in self.entries.values():
+					f.write(json.dumps(entry) + '\n')
+			os.replace(tmp_path, self.path)
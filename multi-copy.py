@@ -4,6 +4,13 @@ import os
 import imutils
 import cv2
 import random
+import sys
+import output_profiles
+from profiling import profiler
+from progress import Progress
+from image_files import walk_images
+from fileops import place_file, LINK_TYPES
+from output_profiles import get_profile, legacy_profile, PROFILES
 
 # print(cv2.__version__)
 
@@ -16,7 +23,11 @@ def parse_args():
 
 	parser.add_argument('--input_img', type=str,
 		default='./input/file.png',
-		help='Directory path to the inputs folder. (default: %(default)s)')
+		help='Path to the image to copy. (default: %(default)s)')
+
+	parser.add_argument('--input_folder', type=str,
+		default=None,
+		help='Copy every image in this folder instead of --input_img. (default: %(default)s)')
 
 	parser.add_argument('--output_folder', type=str,
 		default='./output/',
@@ -60,128 +71,92 @@ def parse_args():
 		default='png',
 		help='Border style to use when using the square process type ["png","jpg"] (default: %(default)s)')
 
-	args = parser.parse_args()
-	return args
-
-
-
-def crop_square_patch(img, imgSize):
-	(h, w) = img.shape[:2]
-
-	rH = random.randint(0,h-imgSize)
-	rW = random.randint(0,w-imgSize)
-	cropped = img[rH:rH+imgSize,rW:rW+imgSize]
-
-	return cropped
-
-def makeResize(img,filename,scale):
-
-	remakePath = args.output_folder + str(scale)+"/"
-	if not os.path.exists(remakePath):
-		os.makedirs(remakePath)
-
-	img_copy = img.copy()
-	img_copy = image_resize(img_copy, max = scale)
-
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, 90])
-
-	if (args.mirror): flipImage(img_copy,new_file,remakePath)
-	if (args.rotate): rotateImage(img_copy,new_file,remakePath)
-
-
-def makeSquare(img,filename,scale):
-	sqPath = args.output_folder + "sq-"+str(scale)+"/"
-	if not os.path.exists(sqPath):
-		os.makedirs(sqPath)
+	parser.add_argument('--link_type', type=str,
+		default='hardlink', choices=[t for t in LINK_TYPES if t != 'rename'],
+		help='How to make the copies after the first one, which is the only one encoded. (default: %(default)s)')
 
-	bType = cv2.BORDER_REPLICATE
-	if(args.border_type == 'solid'):
-		bType = cv2.BORDER_CONSTANT
-	elif (args.border_type == 'reflect'):
-		bType = cv2.BORDER_REFLECT
-	img_sq = img.copy()
-	img_sq = image_resize(img_sq, max = scale)
+	parser.add_argument('--profile', action='store_true',
+		help='Time every stage of the run and print a summary; a Chrome trace is written to profile-trace.json in the output folder.')
 
-	bColor = [int(item) for item in args.border_color.split(',')]
-	print(bColor)
+	parser.add_argument('--output_profile', type=str,
+		default=None,
+		help='Encoder settings for the copies, NAME or NAME:LEVEL; replaces --file_extension. ' + str(sorted(PROFILES)) + ' (default: png-raw, or jpg:90 when --file_extension jpg)')
 
-	(h, w) = img_sq.shape[:2]
-	if(h > w):
-		# pad left/right
-		diff = h-w
-		if(diff%2 == 0):
-			img_sq = cv2.copyMakeBorder(img_sq, 0, 0, int(diff/2), int(diff/2), bType,value=bColor)
-		else:
-			img_sq = cv2.copyMakeBorder(img_sq, 0, 0, int(diff/2)+1, int(diff/2), bType,value=bColor)
-	elif(w > h):
-		# pad top/bottom
-		diff = w-h
-		if(diff%2 == 0):
-			img_sq = cv2.copyMakeBorder(img_sq, int(diff/2), int(diff/2), 0, 0, bType,value=bColor)
-		else:
-			img_sq = cv2.copyMakeBorder(img_sq, int(diff/2), int(diff/2)+1, 0, 0, bType,value=bColor)
-
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + "-sq.png"
-		cv2.imwrite(os.path.join(sqPath, new_file), img_sq, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(sqPath, new_file), img_sq, [cv2.IMWRITE_JPEG_QUALITY, 90])
-
-	if (args.mirror): flipImage(img_sq,new_file,sqPath)
-	if (args.rotate): rotateImage(img_sq,new_file,sqPath)
-
-
-		
-
-def makeSquareCropPatch(img,filename,scale):
-	make_path = args.output_folder + "sq-"+str(scale)+"/"
-	if not os.path.exists(make_path):
-		os.makedirs(make_path)
-
-	img_copy = img.copy()
-	img_copy = crop_square_patch(img_copy,args.max_size)
-
-	new_file = os.path.splitext(filename)[0] + ".png"
-	cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
+	args = parser.parse_args()
+	if args.output_profile:
+		try:
+			get_profile(args.output_profile)
+		except ValueError as e:
+			parser.error('--output_profile: ' + str(e))
+	return args
 
-	if (args.mirror): flipImage(img_copy,new_file,make_path)
-	if (args.rotate): rotateImage(img_copy,new_file,make_path)
 
 
-def copyImage(img,counter):
-	path = args.output_folder
+def copyImage(img,path,filename,counters):
+	# every copy holds the same bytes, so only the first one is encoded
 	if not os.path.exists(path):
 		os.makedirs(path)
 
-	imgCopy = img.copy();
-	formatted = "%04d" % counter;
-
-	if(args.file_extension == "png"):
-		new_file = filename + formatted + ".png"
-		cv2.imwrite(os.path.join(path, new_file), imgCopy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-	elif(args.file_extension == "jpg"):
-		new_file = filename + formatted + ".jpg"
-		cv2.imwrite(os.path.join(path, new_file), imgCopy, [cv2.IMWRITE_JPEG_QUALITY, 90])
+	first = None
+	for counter in counters:
+		formatted = "%04d" % counter;
+		if first is None:
+			first = os.path.join(path, output_profiles.save(img, path, filename + formatted, output_profile))
+		else:
+			with profiler.stage('place_file'): place_file(first, os.path.join(path, filename + formatted + output_profile.extension), args.link_type)
+		progress.update()
+
+def listImages():
+	# the input paths and the folder their copies go to, which keeps the
+	# subfolders of --input_folder
+	if args.input_folder is None:
+		return [(args.input_img, args.output_folder)]
+	images = []
+	stems = {}
+	for root, subdirs, files in profiler.iterate('list', walk_images(args.input_folder)):
+		path = os.path.join(args.output_folder, os.path.relpath(root, args.input_folder))
+		for name in sorted(files):
+			# a.png and a.jpg would write the same copies
+			stem = os.path.join(path, os.path.splitext(name)[0])
+			if stem in stems:
+				sys.exit('%s and %s would write the same copies' % (stems[stem], os.path.join(root, name)))
+			stems[stem] = os.path.join(root, name)
+			images.append((os.path.join(root, name), path))
+	return images
 
-	
 def main():
 	global args
-	global filename
+	global output_profile
+	global progress
 	args = parse_args()
+	if args.profile:
+		profiler.enable()
+	if args.output_profile:
+		output_profile = get_profile(args.output_profile)
+	else:
+		output_profile = legacy_profile(args.file_extension)
 	inter = cv2.INTER_CUBIC
 	os.environ['OPENCV_IO_ENABLE_JASPER']= "true"
 
-	filename = os.path.splitext(os.path.basename(args.input_img))[0]
-
-	for x in range(args.start,args.end):
-		img = cv2.imread(args.input_img)
-		copyImage(img,x)
+	images = listImages()
+	copies = range(args.start,args.end)
+	progress = Progress(len(images) * len(copies), output_profiles.stats.size, not args.verbose)
+	for file_path, path in images:
+		if(args.verbose): print('\t- file ' + file_path)
+		with profiler.stage('read'): img = cv2.imread(file_path)
+		profiler.count_file('read', file_path)
+		if not hasattr(img, 'copy'):
+			progress.update(images=len(copies), error=True)
+			continue
+		progress.update(images=0, bytes_in=os.path.getsize(file_path))
+
+		filename = os.path.splitext(os.path.basename(file_path))[0]
+		with profiler.stage('copyImage'): copyImage(img,path,filename,copies)
+		profiler.image_done()
+	progress.finish()
+
+	output_profiles.print_summary()
+	profiler.finish(args.output_folder + "profile-trace.json")
 
 	# for root, subdirs, files in os.walk(args.input_folder):
 	# 	print('--\nroot = ' + root)
@@ -1,11 +1,18 @@
 import argparse
 import numpy as np
-import scipy.ndimage as pyimg
 import os
-import imutils
 import cv2
 import random
 import math
+from manifest import Manifest
+import output_profiles
+from profiling import profiler
+from progress import Progress
+from image_files import walk_images, iter_images
+from fileops import place_file
+import augment
+import distance
+from output_profiles import get_profile, legacy_profile, PROFILES
 
 # print(cv2.__version__)
 
@@ -83,6 +90,19 @@ def parse_args():
         default='255,255,255',
         help='border color to use with the `solid` border type; use bgr values (default: %(default)s)')
 
+    parser.add_argument('--distance_backend', type=str,
+        default='opencv',
+        choices=distance.BACKENDS,
+        help='How to work out the distance fields of --process_type distance: opencv is exact like scipy and faster, the mask ones are approximate and faster still. (default: %(default)s)')
+
+    parser.add_argument('--distance_clamp', type=int, nargs=2,
+        default=[32,200],
+        help='Largest distance kept in the green (light to dark) and blue (dark to light) channels of --process_type distance, at most 255. (default: %(default)s)')
+
+    parser.add_argument('--distance_scale', type=float,
+        default=1.0,
+        help='Work out the distance fields at this fraction of the output size and resize them back; faster, less exact near edges. (default: %(default)s)')
+
     parser.add_argument('--jpeg_quality', type=int,
         default=100,
         help='the quality for jpeg to be saved; use 90 or 100 for most of the cases (default: %(default)s)')
@@ -97,19 +117,90 @@ def parse_args():
     parser.add_argument('--rotate', action='store_true',
         help='Adds 90 degree rotation augmentation.')
 
+    parser.add_argument('--augment', type=str, nargs='+',
+        default=[],
+        choices=list(augment.VARIANTS),
+        help='Mirrored and rotated copies to write next to every output; --mirror adds flipped, --rotate adds rot90 rot180 rot270. (default: none)')
+
     parser.add_argument('--file_extension', type=str,
         default='png',
         help='Border style to use when using the square process type ["png","jpg"] (default: %(default)s)')
 
+    parser.add_argument('--profile', action='store_true',
+        help='Time every stage of the run and print a summary; a Chrome trace is written to profile-trace.json in the output folder.')
+
+    parser.add_argument('--output_profile', type=str,
+        default=None,
+        help='Encoder settings for every output, NAME or NAME:LEVEL (compression level or quality); replaces --file_extension and --jpeg_quality. ' + str(sorted(PROFILES)) + ' (default: png-raw, or jpg with --jpeg_quality when --file_extension jpg)')
+
+    parser.add_argument('--force', action='store_true',
+        help='Process every image again, even the ones the manifest in the output folder marks as done.')
+
+    parser.add_argument('--class_cap', type=int,
+        default=None,
+        help='Process at most this many images of every class folder, sampled with --class_seed; the rest are never read. (default: all)')
+
+    parser.add_argument('--class_target', type=int,
+        default=None,
+        help='Like --class_cap, and classes with fewer images have their outputs repeated (as hardlinks named <name>-r1, -r2, ...) until they have this many. (default: none)')
+
+    parser.add_argument('--class_seed', type=int,
+        default=0,
+        help='Seed for picking the images of classes that are over their quota; the same seed picks the same images. (default: %(default)s)')
+
     feature_parser = parser.add_mutually_exclusive_group(required=False)
     feature_parser.add_argument('--keep_name', dest='name', action='store_true')
     feature_parser.add_argument('--numbered', dest='name', action='store_false')
     parser.set_defaults(name=True)
 
     args = parser.parse_args()
+    if args.output_profile:
+        try:
+            get_profile(args.output_profile)
+        except ValueError as e:
+            parser.error('--output_profile: ' + str(e))
+    args.augment = augment.select(args.augment, args.mirror, args.rotate)
+    if args.class_cap is not None and args.class_target is not None:
+        parser.error('give --class_cap or --class_target, not both')
+    if not all(0 <= clamp <= 255 for clamp in args.distance_clamp):
+        parser.error('--distance_clamp values must be between 0 and 255')
+    if not 0 < args.distance_scale <= 1:
+        parser.error('--distance_scale must be above 0 and at most 1')
     return args
 
 
+def setupProfiles():
+    global output_profile
+    global png_profile
+    if args.output_profile:
+        output_profile = get_profile(args.output_profile)
+        png_profile = output_profile
+    else:
+        output_profile = legacy_profile(args.file_extension, args.jpeg_quality)
+        # the writers that have always written uncompressed png keep doing so
+        png_profile = get_profile('png-raw')
+
+def writeImage(img,path,new_file,profile):
+    # encode in memory and move the finished file into place, so an
+    # interrupted run never leaves a truncated image behind
+    file_path = os.path.join(path, new_file)
+    data = output_profiles.encode(img, profile)
+
+    with profiler.stage('write'):
+        tmp_path = os.path.join(path, '.' + new_file + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+    profiler.count('write', len(data))
+    written.append(file_path)
+
+def saveImage(img,path,filename,suffix="",profile=None):
+    if profile is None:
+        profile = output_profile
+    new_file = os.path.splitext(filename)[0] + suffix + profile.extension
+    writeImage(img, path, new_file, profile)
+    return new_file
+
 def image_resize(image, width = None, height = None, max = None):
     # initialize the dimensions of the image to be resized and
     # grab the image size
@@ -163,7 +254,7 @@ def image_resize_to_rectangle(image, target_width=1280, target_height=768, allow
 
     if allow_rotating and h > w:
         # why not rotating it ?
-        image = imutils.rotate_bound(image, 90)
+        image = augment.VARIANTS["rot90"](image)
         (h, w) = image.shape[:2]
 
     need_to_stretch = h < target_height or w < target_width
@@ -253,7 +344,6 @@ def crop_to_square(img):
     cropped = img.copy()
     if w > h:   
         if (args.h_align=='left'):
-            print('here first')
             cropped = img[:h,:h]
         elif (args.h_align=='right'):
             cropped = img[0:h, w-h:w]
@@ -310,15 +400,9 @@ def makeResize(img,filename,scale,subdir):
     img_copy = img.copy()
     img_copy = image_resize(img_copy, max = scale)
 
-    if(args.file_extension == "png"):
-        new_file = os.path.splitext(filename)[0] + ".png"
-        cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        new_file = os.path.splitext(filename)[0] + ".jpg"
-        cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+    new_file = saveImage(img_copy, remakePath, filename)
 
-    if (args.mirror): flipImage(img_copy,new_file,remakePath)
-    if (args.rotate): rotateImage(img_copy,new_file,remakePath)
+    augmentImage(img_copy,new_file,remakePath)
 
 def makeResizeToRectangle(img,filename,width,height,allow_rotating,subdir):
     remakePath = args.output_folder + "-resize_rectangle-"+str(width)+"x"+str(height)+"/" + subdir + "/"
@@ -328,15 +412,9 @@ def makeResizeToRectangle(img,filename,width,height,allow_rotating,subdir):
     img_copy = img.copy()
     img_copy = image_resize_to_rectangle(img_copy, target_width = width, target_height = height, allow_rotating=allow_rotating)
 
-    if(args.file_extension == "png"):
-        new_file = os.path.splitext(filename)[0] + ".png"
-        cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        new_file = os.path.splitext(filename)[0] + ".jpg"
-        cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+    new_file = saveImage(img_copy, remakePath, filename)
 
-    if (args.mirror): flipImage(img_copy,new_file,remakePath)
-    if (args.rotate): rotateImage(img_copy,new_file,remakePath)
+    augmentImage(img_copy,new_file,remakePath)
 
 def makeDistance(img,filename,scale,subdir):
     makePath = args.output_folder + "distance-"+ str(args.max_size)+"/" + subdir + "/"
@@ -346,23 +424,11 @@ def makeDistance(img,filename,scale,subdir):
     img_copy = img.copy()
     img_copy = image_resize(img_copy, max = scale)
 
-    BW = img_copy[:,:,0] > 127
-    G_channel = pyimg.distance_transform_edt(BW)
-    G_channel[G_channel>32]=32
-    B_channel = pyimg.distance_transform_edt(1-BW)
-    B_channel[B_channel>200]=200
-    img_copy[:,:,1] = G_channel.astype('uint8')
-    img_copy[:,:,0] = B_channel.astype('uint8')
+    img_copy = distance.distance_image(img_copy, args.distance_backend, args.distance_clamp, args.distance_scale)
 
-    if(args.file_extension == "png"):
-        new_file = os.path.splitext(filename)[0] + ".png"
-        cv2.imwrite(os.path.join(makePath, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        new_file = os.path.splitext(filename)[0] + ".jpg"
-        cv2.imwrite(os.path.join(makePath, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+    new_file = saveImage(img_copy, makePath, filename)
 
-    if (args.mirror): flipImage(img_copy,new_file,makePath)
-    if (args.rotate): rotateImage(img_copy,new_file,makePath)
+    augmentImage(img_copy,new_file,makePath)
 
 def makeScale(img,filename,scale,subdir):
 
@@ -374,11 +440,9 @@ def makeScale(img,filename,scale,subdir):
     
     img_copy = image_scale(img_copy, scale)
 
-    new_file = os.path.splitext(filename)[0] + ".png"
-    cv2.imwrite(os.path.join(remakePath, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
+    new_file = saveImage(img_copy, remakePath, filename, "", png_profile)
 
-    if (args.mirror): flipImage(img_copy,new_file,remakePath)
-    if (args.rotate): rotateImage(img_copy,new_file,remakePath)
+    augmentImage(img_copy,new_file,remakePath)
 
 def makeSquare(img,filename,scale,subdir):
     sqPath = args.output_folder + "sq-"+str(scale)+"/" + subdir + "/"
@@ -421,15 +485,9 @@ def makeSquare(img,filename,scale,subdir):
         else:
             img_sq = cv2.copyMakeBorder(img_sq, int(diff/2), int(diff/2)+1, int(diff/2), int(diff/2)+1, bType,value=bColor)
 
-    if(args.file_extension == "png"):
-        new_file = os.path.splitext(filename)[0] + ".png"
-        cv2.imwrite(os.path.join(sqPath, new_file), img_sq, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        new_file = os.path.splitext(filename)[0] + ".jpg"
-        cv2.imwrite(os.path.join(sqPath, new_file), img_sq, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+    new_file = saveImage(img_sq, sqPath, filename)
 
-    if (args.mirror): flipImage(img_sq,new_file,sqPath)
-    if (args.rotate): rotateImage(img_sq,new_file,sqPath)
+    augmentImage(img_sq,new_file,sqPath)
 
     
     
@@ -444,15 +502,9 @@ def makeCanny(img,filename,scale,subdir):
     gray = processCanny(img_copy)
 
     # save out
-    if(args.file_extension == "png"):
-        new_file = os.path.splitext(filename)[0] + ".png"
-        cv2.imwrite(os.path.join(make_path, new_file), gray, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        new_file = os.path.splitext(filename)[0] + ".jpg"
-        cv2.imwrite(os.path.join(make_path, new_file), gray, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+    new_file = saveImage(gray, make_path, filename)
 
-    if (args.mirror): flipImage(img_copy,new_file,make_path)
-    if (args.rotate): rotateImage(img_copy,new_file,make_path)
+    augmentImage(gray,new_file,make_path)
 
 def makeCrop(img,filename,subdir):
     make_path = args.output_folder + "crop-"+str(args.height)+"x"+str(args.width)+"/" + subdir + "/"
@@ -463,15 +515,9 @@ def makeCrop(img,filename,subdir):
     img_copy,error = arbitrary_crop(img_copy,args.height,args.width)
 
     if (error==False):
-        if(args.file_extension == "png"):
-            new_file = os.path.splitext(filename)[0] + ".png"
-            cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-        elif(args.file_extension == "jpg"):
-            new_file = os.path.splitext(filename)[0] + ".jpg"
-            cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-        if (args.mirror): flipImage(img_copy,new_file,make_path)
-        if (args.rotate): rotateImage(img_copy,new_file,make_path)
+        new_file = saveImage(img_copy, make_path, filename)
+
+        augmentImage(img_copy,new_file,make_path)
     else:
         if(args.verbose): print(filename+" returned an error")
 
@@ -482,15 +528,9 @@ def makeCropCenterSquare(img,filename,max_size):
     img_copy = img.copy()
     img_copy = crop_center_square(img_copy, max_size)
 
-    if(args.file_extension == "png"):
-        new_file = os.path.splitext(filename)[0] + ".png"
-        cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        new_file = os.path.splitext(filename)[0] + ".jpg"
-        cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+    new_file = saveImage(img_copy, make_path, filename)
 
-    if (args.mirror): flipImage(img_copy,new_file,make_path)
-    if (args.rotate): rotateImage(img_copy,new_file,make_path)
+    augmentImage(img_copy,new_file,make_path)
 
 def makeSquareCrop(img,filename,scale,subdir):
     make_path = args.output_folder + "sq-"+str(scale)+"/" + subdir + "/"
@@ -501,15 +541,9 @@ def makeSquareCrop(img,filename,scale,subdir):
     img_copy = crop_to_square(img_copy)
     img_copy = image_resize(img_copy, max = scale)
 
-    if(args.file_extension == "png"):
-        new_file = os.path.splitext(filename)[0] + ".png"
-        cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        new_file = os.path.splitext(filename)[0] + ".jpg"
-        cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+    new_file = saveImage(img_copy, make_path, filename)
 
-    if (args.mirror): flipImage(img_copy,new_file,make_path)
-    if (args.rotate): rotateImage(img_copy,new_file,make_path)
+    augmentImage(img_copy,new_file,make_path)
 
 def makeManySquares(img,filename,scale,subdir):
     make_path = args.output_folder + "many_squares-"+str(scale)+"/" + subdir + "/"
@@ -525,43 +559,33 @@ def makeManySquares(img,filename,scale,subdir):
         #crop images from top and bottom
         crop = img_copy[0:w,0:w]
         crop = image_resize(crop, max = scale)
-        new_file = os.path.splitext(filename)[0] + "-1.png"
-        cv2.imwrite(os.path.join(make_path, new_file), crop, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-        if (args.mirror): flipImage(crop,new_file,make_path)
-        if (args.rotate): rotateImage(crop,filename,make_path)
+        new_file = saveImage(crop, make_path, filename, "-1", png_profile)
+        augmentImage(crop,new_file,make_path)
 
         crop = img_copy[h-w:h,0:w]
         crop = image_resize(crop, max = scale)
-        new_file = os.path.splitext(filename)[0] + "-2.png"
-        cv2.imwrite(os.path.join(make_path, new_file), crop, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-        if (args.mirror): flipImage(crop,new_file,make_path)
-        if (args.rotate): rotateImage(crop,filename,make_path)
+        new_file = saveImage(crop, make_path, filename, "-2", png_profile)
+        augmentImage(crop,new_file,make_path)
 
     elif(img_ratio <= .8):
         #crop images from left and right
-        print(os.path.splitext(filename)[0] + ': wide image')
+        if(args.verbose): print(os.path.splitext(filename)[0] + ': wide image')
         
         crop = img_copy[0:h,0:h]
         crop = image_resize(crop, max = scale)
-        new_file = os.path.splitext(filename)[0] + "-wide1.png"
-        cv2.imwrite(os.path.join(make_path, new_file), crop, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-        if (args.mirror): flipImage(crop,new_file,make_path)
-        if (args.rotate): rotateImage(crop,filename,make_path)
+        new_file = saveImage(crop, make_path, filename, "-wide1", png_profile)
+        augmentImage(crop,new_file,make_path)
 
         crop = img_copy[0:h,w-h:w]
         crop = image_resize(crop, max = scale)
-        new_file = os.path.splitext(filename)[0] + "-wide2.png"
-        cv2.imwrite(os.path.join(make_path, new_file), crop, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-        if (args.mirror): flipImage(crop,new_file,make_path)
-        if (args.rotate): rotateImage(crop,filename,make_path)
+        new_file = saveImage(crop, make_path, filename, "-wide2", png_profile)
+        augmentImage(crop,new_file,make_path)
 
     else:
         img_copy = crop_to_square(img_copy)
         img_copy = image_resize(img_copy, max = scale)
-        new_file = os.path.splitext(filename)[0] + ".png"
-        cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-        if (args.mirror): flipImage(img_copy,new_file,make_path)
-        if(args.rotate): rotateImage(img_copy,filename,make_path)
+        new_file = saveImage(img_copy, make_path, filename, "", png_profile)
+        augmentImage(img_copy,new_file,make_path)
         
 
 def makeSquareCropPatch(img,filename,scale,subdir):
@@ -572,11 +596,9 @@ def makeSquareCropPatch(img,filename,scale,subdir):
     img_copy = img.copy()
     img_copy = crop_square_patch(img_copy,args.max_size)
 
-    new_file = os.path.splitext(filename)[0] + ".png"
-    cv2.imwrite(os.path.join(make_path, new_file), img_copy, [cv2.IMWRITE_PNG_COMPRESSION, 0])
+    new_file = saveImage(img_copy, make_path, filename, "", png_profile)
 
-    if (args.mirror): flipImage(img_copy,new_file,make_path)
-    if (args.rotate): rotateImage(img_copy,new_file,make_path)
+    augmentImage(img_copy,new_file,make_path)
 
 def makePix2Pix(img,filename,scale,subdir,direction="BtoA",value=[0,0,0]):
     img_p2p = img.copy()
@@ -594,44 +616,12 @@ def makePix2Pix(img,filename,scale,subdir,direction="BtoA",value=[0,0,0]):
         img_p2p = cv2.copyMakeBorder(img_p2p, 0, 0, w, 0, bType, None, value)
         img_p2p[0:h,0:w] = canny
     
-    if(args.file_extension == "png"):
-        new_file = os.path.splitext(filename)[0] + ".png"
-        cv2.imwrite(os.path.join(make_path, new_file), img_p2p, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        new_file = os.path.splitext(filename)[0] + ".jpg"
-        cv2.imwrite(os.path.join(make_path, new_file), img_p2p, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-def flipImage(img,filename,path):
-    flip_img = cv2.flip(img, 1)
-    flip_file = os.path.splitext(filename)[0] + "-flipped.png"
-    cv2.imwrite(os.path.join(path, flip_file), flip_img, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-
-def rotateImage(img,filename,path):
-    r = img.copy() 
-    r = imutils.rotate_bound(r, 90)
-
-    if(args.file_extension == "png"):
-        r_file = os.path.splitext(filename)[0] + "-rot90.png"
-        cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        r_file = os.path.splitext(filename)[0] + "-rot90.jpg"
-        cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-    r = imutils.rotate_bound(r, 90)
-    if(args.file_extension == "png"):
-        r_file = os.path.splitext(filename)[0] + "-rot180.png"
-        cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        r_file = os.path.splitext(filename)[0] + "-rot180.jpg"
-        cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
-
-    r = imutils.rotate_bound(r, 90)
-    if(args.file_extension == "png"):
-        r_file = os.path.splitext(filename)[0] + "-rot270.png"
-        cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-    elif(args.file_extension == "jpg"):
-        r_file = os.path.splitext(filename)[0] + "-rot270.jpg"
-        cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])
+    new_file = saveImage(img_p2p, make_path, filename)
+
+def augmentImage(img,filename,path):
+    with profiler.stage('augmentImage'):
+        for suffix, variant in augment.augment(img, args.augment):
+            saveImage(variant, path, filename, suffix)
 
 def processImage(img,filename,subdir):
     if args.process_type == "resize":       
@@ -661,42 +651,124 @@ def processImage(img,filename,subdir):
     if args.process_type == "distance":
         makeDistance(img,filename,args.max_size,subdir)
 
+# arguments that do not change what gets written
+RUN_ONLY_ARGS = ['verbose','input_folder','output_folder','force','profile','class_cap','class_target','class_seed']
+
+def processFile(manifest,progress,root,filename):
+    # returns the outputs of the image, or None if the file is not one
+    global count
+    global written
+    file_path = os.path.join(root, filename)
+    if(args.verbose): print('\t- file %s (full path: %s)' % (filename, file_path))
+    current_subdir = os.path.split(root)[1]
+
+    name = filename if args.name else str(count)
+    stamp = manifest.stamp(file_path)
+    entry = manifest.done(file_path, name, stamp)
+    if entry and not args.force:
+        if(args.verbose): print('skipping unchanged image: ' + file_path)
+        progress.update(skipped=True)
+        if not entry['image']:
+            return None
+        count = count + int(1)
+        return [os.path.join(args.output_folder, output) for output in entry['outputs']]
+
+    written = []
+    with profiler.stage('read'): img = cv2.imread(file_path)
+    profiler.count_file('read', file_path)
+
+    decoded = hasattr(img, 'copy')
+    if decoded:
+        if(args.verbose): print('processing image: ' + filename)
+        with profiler.stage(args.process_type): processImage(img,name,current_subdir)
+        profiler.image_done()
+        count = count + int(1)
+    manifest.record(file_path, name, stamp, written, decoded)
+    progress.update(bytes_in=stamp[0], error=not decoded)
+    return written if decoded else None
+
+def listClasses(magic=True):
+    # the leaf folders are the classes; only their listings are needed to plan the run
+    for root, subdirs, files in profiler.iterate('list', walk_images(args.input_folder, magic)):
+        if(args.verbose): print('--\nroot = ' + root)
+        if len(subdirs) > 0:
+            continue
+        yield root, files
+
+def sampleClass(root,files):
+    # the order in which a class is read; the first images of it that decode
+    # fill its quota, so unreadable files are replaced by the next ones
+    order = sorted(files)
+    seed = '%d:%s' % (args.class_seed, os.path.relpath(root, args.input_folder))
+    random.Random(seed).shuffle(order)
+    return order
+
+def repeatOutputs(images,quota):
+    # links the outputs of a class that is short of its target under new names
+    for i in range(quota - len(images)):
+        (name, outputs) = images[i % len(images)]
+        stem = os.path.splitext(os.path.basename(name))[0]
+        repeat = '-r%d' % (i // len(images) + 1)
+        for output in outputs:
+            (path, output_file) = os.path.split(output)
+            with profiler.stage('place_file'): place_file(output, os.path.join(path, stem + repeat + output_file[len(stem):]), 'hardlink')
+
+def processClasses(manifest,progress,classes):
+    # one image of every class in turn, so a run stopped early is still balanced
+    quota = args.class_cap if args.class_cap is not None else args.class_target
+    queues = [(root, sampleClass(root, files), []) for root, files in classes]
+    progress.total = sum(min(quota, len(files)) for root, files in classes)
+    while queues:
+        for queue in list(queues):
+            (root, order, images) = queue
+            if len(images) < quota and order:
+                filename = order.pop(0)
+                name = filename if args.name else str(count)
+                outputs = processFile(manifest, progress, root, filename)
+                if outputs is not None:
+                    images.append((name, outputs))
+                elif len(order) >= quota - len(images):
+                    # another file takes its place
+                    progress.total += 1
+                continue
+
+            queues.remove(queue)
+            if args.class_target is not None and images:
+                repeatOutputs(images, quota)
+
 def main():
     global args
     global count
     global inter
+    global written
     args = parse_args()
+    if args.profile:
+        profiler.enable()
     count = int(0)
     inter = cv2.INTER_CUBIC
     os.environ['OPENCV_IO_ENABLE_JASPER']= "true"
+    setupProfiles()
 
-    base_dir = ''
-
-    for root, subdirs, files in os.walk(args.input_folder):
-        if(args.verbose): print('--\nroot = ' + root)
-
-        if len(subdirs) > 0:
-            base_dir = root 
-            continue
+    settings = dict((k, v) for k, v in vars(args).items() if k not in RUN_ONLY_ARGS)
+    manifest = Manifest(args.output_folder + "manifest.jsonl", args.input_folder, settings)
 
-        for subdir in subdirs:
-            if(args.verbose): print('\t- subdirectory ' + subdir)
+    progress = Progress(bytes_out=output_profiles.stats.size, redraw=not args.verbose)
 
-        current_subdir = os.path.split(root)[1]
-
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            if(args.verbose): print('\t- file %s (full path: %s)' % (filename, file_path))
-            
-            img = cv2.imread(file_path)
-
-            if hasattr(img, 'copy'):
-                print('processing image: ' + filename)
-                if args.name:
-                    processImage(img,filename,current_subdir)
-                else:
-                    processImage(img,str(count),current_subdir)
-                count = count + int(1)
+    try:
+        if args.class_cap is None and args.class_target is None:
+            progress.count(iter_images(args.input_folder, magic=False))
+            for root, files in listClasses():
+                for filename in files:
+                    processFile(manifest, progress, root, filename)
+        else:
+            # by name only, no file beyond the quotas is opened
+            processClasses(manifest, progress, list(listClasses(magic=False)))
+    finally:
+        manifest.close()
+    progress.finish()
+
+    output_profiles.print_summary()
+    profiler.finish(args.output_folder + "profile-trace.json")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+import os
+import time
+import threading
+import collections
+import cv2
+from profiling import profiler
+
+# Named encoder settings shared by every script that writes images, plus a
+# tally of bytes written and time spent encoding for the end of run summary.
+#
+# A profile can be given as NAME or NAME:LEVEL, where LEVEL replaces the main
+# knob of the profile: the compression level (0-9) for the png profiles and
+# the quality for the jpg and lossy webp ones, e.g. "jpg-progressive:90".
+
+Profile = collections.namedtuple('Profile', ['name', 'extension', 'params'])
+
+PROFILES = {
+	# what the scripts have always written: no compression at all
+	'png-raw': ('.png', [cv2.IMWRITE_PNG_COMPRESSION, 0]),
+	'png-fast': ('.png', [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+	'png': ('.png', [cv2.IMWRITE_PNG_COMPRESSION, 6]),
+	'png-small': ('.png', [cv2.IMWRITE_PNG_COMPRESSION, 9]),
+	# run length encoding, fast and good for flat or synthetic images
+	'png-rle': ('.png', [cv2.IMWRITE_PNG_COMPRESSION, 6, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]),
+	# 1 bit per pixel, for black and white edge maps
+	'png-bilevel': ('.png', [cv2.IMWRITE_PNG_COMPRESSION, 9, cv2.IMWRITE_PNG_BILEVEL, 1]),
+	'jpg': ('.jpg', [cv2.IMWRITE_JPEG_QUALITY, 95]),
+	'jpg-progressive': ('.jpg', [cv2.IMWRITE_JPEG_QUALITY, 95, cv2.IMWRITE_JPEG_PROGRESSIVE, 1, cv2.IMWRITE_JPEG_OPTIMIZE, 1]),
+	'webp': ('.webp', [cv2.IMWRITE_WEBP_QUALITY, 90]),
+	# quality above 100 selects lossless webp
+	'webp-lossless': ('.webp', [cv2.IMWRITE_WEBP_QUALITY, 101]),
+}
+
+# the levels each format takes: png compression, jpg and webp quality
+LEVELS = {'.png': (0, 9), '.jpg': (0, 100), '.webp': (1, 100)}
+
+# the image_probe format name of each extension, for scripts that link files
+# which are already in the output format instead of re-encoding them
+FORMATS = {'.png': 'png', '.jpg': 'jpeg', '.webp': 'webp'}
+
+def get_profile(spec):
+	(name, _, level) = spec.partition(':')
+	if name not in PROFILES:
+		raise ValueError('unknown output profile "%s", choose from %s' % (name, ', '.join(sorted(PROFILES))))
+
+	(extension, params) = PROFILES[name]
+	params = list(params)
+	if level:
+		if name == 'webp-lossless':
+			raise ValueError('webp-lossless has no level')
+		(low, high) = LEVELS[extension]
+		try:
+			level = int(level)
+		except ValueError:
+			raise ValueError('the level of %s must be a number from %d to %d, not %s' % (name, low, high, level))
+		if not low <= level <= high:
+			raise ValueError('the level of %s must be from %d to %d, not %d' % (name, low, high, level))
+		params[1] = level
+	return Profile(spec, extension, params)
+
+def legacy_profile(file_extension, jpeg_quality=90):
+	# what --file_extension meant before there were profiles
+	if file_extension == "jpg":
+		return Profile('jpg:' + str(jpeg_quality), '.jpg', [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+	return get_profile('png-raw')
+
+class EncodeStats:
+	# images, bytes and seconds per profile; safe to add to from writer threads
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.totals = {}
+
+	def add(self, name, images, size, seconds):
+		with self.lock:
+			total = self.totals.setdefault(name, [0, 0, 0.0])
+			total[0] += images
+			total[1] += size
+			total[2] += seconds
+
+	def take(self):
+		# hand the totals so far to another process and start from zero
+		with self.lock:
+			totals = self.totals
+			self.totals = {}
+		return totals
+
+	def merge(self, totals):
+		for name, (images, size, seconds) in totals.items():
+			self.add(name, images, size, seconds)
+
+	def size(self):
+		# bytes written so far over all profiles
+		with self.lock:
+			return sum(total[1] for total in self.totals.values())
+
+	def summary(self):
+		lines = []
+		for name, (images, size, seconds) in sorted(self.totals.items()):
+			mb = size / float(1024 * 1024)
+			lines.append('%s: %d images, %.1f MB written (%.1f KB/image), encoding took %.1f s (%.1f ms/image, %.1f MB/s)' % (
+				name, images, mb, size / 1024.0 / max(images, 1), seconds,
+				1000.0 * seconds / max(images, 1), mb / max(seconds, 1e-9)))
+		return '\n'.join(lines)
+
+stats = EncodeStats()
+
+def encode(img, profile):
+	start = time.perf_counter()
+	with profiler.stage('encode'):
+		ok, data = cv2.imencode(profile.extension, img, profile.params)
+	seconds = time.perf_counter() - start
+	if not ok:
+		raise IOError('could not encode image as ' + profile.name)
+	stats.add(profile.name, 1, len(data), seconds)
+	return data.tobytes()
+
+def save(img, path, stem, profile):
+	# writes path/stem + the profile's extension, returns the file name
+	new_file = stem + profile.extension
+	data = encode(img, profile)
+	with profiler.stage('write'):
+		with open(os.path.join(path, new_file), 'wb') as f:
+			f.write(data)
+	profiler.count('write', len(data))
+	return new_file
+
+def print_summary():
+	if stats.totals:
+		print(stats.summary())
@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+try:
+	import resource
+except ImportError:
+	# windows
+	resource = None
+
+# Per-stage timing for --profile: wall time and bytes of every stage, the
+# peak memory after every image, a summary table and a Chrome trace
+# (chrome://tracing or https://ui.perfetto.dev) with one track per process
+# and thread.
+#
+# Stages nest; the table counts each stage's own time only, so a transform
+# that writes its outputs itself does not also count the encoding. When
+# profiling is off, stage() costs one attribute lookup.
+
+NO_STAGE = contextlib.nullcontext()
+DONE = object()
+
+def peak_rss():
+	# bytes; ru_maxrss is in kilobytes on linux and in bytes on macOS
+	if resource is None:
+		return 0
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss if sys.platform == 'darwin' else rss * 1024
+
+class Profiler:
+	def __init__(self):
+		self.enabled = False
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.start = time.perf_counter()
+		self.events = []
+		self.totals = {}
+		self.peak = 0
+
+	def enable(self):
+		# also clears what a forked worker inherited from the main process
+		self.enabled = True
+		self.local = threading.local()
+		self.start = time.perf_counter()
+		self.events = []
+		self.totals = {}
+		self.peak = 0
+
+	def stage(self, name):
+		if not self.enabled:
+			return NO_STAGE
+		return self.timed(name)
+
+	@contextlib.contextmanager
+	def timed(self, name):
+		stack = getattr(self.local, 'stack', None)
+		if stack is None:
+			# first stage of this thread: name its track in the trace
+			stack = self.local.stack = []
+			with self.lock:
+				self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': threading.get_ident(),
+					'args': {'name': threading.current_thread().name}})
+		frame = [name, time.perf_counter(), 0.0]
+		stack.append(frame)
+		try:
+			yield
+		finally:
+			end = time.perf_counter()
+			stack.pop()
+			duration = end - frame[1]
+			if stack:
+				stack[-1][2] += duration
+			self.add(name, duration - frame[2], 0)
+			event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+				'ts': round((frame[1] - self.start) * 1e6, 1), 'dur': round(duration * 1e6, 1)}
+			with self.lock:
+				self.events.append(event)
+
+	def add(self, name, seconds, size, calls=1):
+		with self.lock:
+			total = self.totals.setdefault(name, [0, 0.0, 0])
+			total[0] += calls
+			total[1] += seconds
+			total[2] += size
+
+	def count(self, name, size):
+		# bytes read or written by a stage
+		if self.enabled:
+			self.add(name, 0.0, size, 0)
+
+	def count_file(self, name, path):
+		# the size of a file a stage read, only looked up when profiling
+		if self.enabled:
+			self.add(name, 0.0, os.path.getsize(path), 0)
+
+	def iterate(self, name, iterable):
+		# times every step of an iterator (e.g. os.walk) but not the loop body
+		if not self.enabled:
+			return iterable
+		return self.timed_iterate(name, iterable)
+
+	def timed_iterate(self, name, iterable):
+		iterator = iter(iterable)
+		while True:
+			with self.stage(name):
+				item = next(iterator, DONE)
+			if item is DONE:
+				return
+			yield item
+
+	def image_done(self):
+		# call after every image to follow the memory use
+		if self.enabled:
+			rss = peak_rss()
+			event = {'name': 'peak rss (MB)', 'ph': 'C', 'pid': os.getpid(),
+				'ts': round((time.perf_counter() - self.start) * 1e6, 1), 'args': {'MB': round(rss / 1048576.0, 1)}}
+			with self.lock:
+				self.peak = max(self.peak, rss)
+				self.events.append(event)
+
+	def take(self):
+		# hand everything recorded so far to the main process and start over
+		with self.lock:
+			taken = (self.events, self.totals, self.peak, time.time() - (time.perf_counter() - self.start))
+			self.events = []
+			self.totals = {}
+		return taken
+
+	def merge(self, taken):
+		(events, totals, peak, start) = taken
+		# worker clocks start later than ours, shift their events onto our timeline
+		shift = (start - (time.time() - (time.perf_counter() - self.start))) * 1e6
+		with self.lock:
+			for event in events:
+				if 'ts' in event:
+					event['ts'] = round(event['ts'] + shift, 1)
+				self.events.append(event)
+			self.peak = max(self.peak, peak)
+		for name, (calls, seconds, size) in totals.items():
+			self.add(name, seconds, size, calls)
+
+	def summary(self):
+		wall = time.perf_counter() - self.start
+		lines = ['%-24s %9s %10s %10s %7s %10s' % ('stage', 'calls', 'total s', 'mean ms', '% wall', 'MB')]
+		for name, (calls, seconds, size) in sorted(self.totals.items(), key=lambda item: -item[1][1]):
+			lines.append('%-24s %9d %10.2f %10.3f %6.1f%% %10.1f' % (name, calls, seconds,
+				1000.0 * seconds / max(calls, 1), 100.0 * seconds / max(wall, 1e-9), size / 1048576.0))
+		lines.append('wall time %.2f s, peak rss %.1f MB (stage times of several processes or threads add up to more than the wall time)' % (wall, max(self.peak, peak_rss()) / 1048576.0))
+		return '\n'.join(lines)
+
+	def finish(self, trace_path):
+		# prints the table and writes the trace
+		if not self.enabled:
+			return
+		self.image_done()
+		print(self.summary())
+
+		metadata = []
+		for pid in sorted(set(event['pid'] for event in self.events)):
+			label = 'main' if pid == os.getpid() else 'worker %d' % pid
+			metadata.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': label}})
+
+		folder = os.path.dirname(trace_path)
+		if folder:
+			os.makedirs(folder, exist_ok=True)
+		with open(trace_path, 'w') as f:
+			json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, f)
+		print('trace written to ' + trace_path)
+
+profiler = Profiler()
@@ -0,0 +1,94 @@
+import sys
+import time
+import threading
+
+# One status line instead of a line per file: images done, images/s, MB/s
+# read and written, errors, skipped files and the time left. The line is
+# redrawn at most once per interval, so calling update() for every image
+# costs next to nothing.
+#
+# The total can be counted on a background thread while the run starts
+# (count), in which case the percentage and time left show up once
+# the count is done.
+
+def format_time(seconds):
+	seconds = int(seconds)
+	return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class Progress:
+	def __init__(self, total=None, bytes_out=None, redraw=True, interval=None, stream=sys.stderr):
+		# bytes_out returns the bytes written so far, e.g. output_profiles.stats.size;
+		# redraw=False keeps the lines apart, for runs that print more than this
+		self.total = total
+		self.bytes_out = bytes_out
+		self.stream = stream
+		self.tty = stream.isatty() and redraw
+		# a log file gets a new line now and then instead of a redrawn one
+		self.interval = interval if interval is not None else (0.5 if self.tty else 30.0)
+		self.start = time.monotonic()
+		self.last = self.start
+		self.images = 0
+		self.skipped = 0
+		self.errors = 0
+		self.bytes_in = 0
+		self.width = 0
+
+	def count(self, paths):
+		# the total is the length of paths, e.g. image_files.iter_images(folder,
+		# magic=False), which names the files without opening them; counted on
+		# a background thread so the run does not wait for it
+		def count():
+			total = sum(1 for path in paths)
+			if self.total is None:
+				self.total = total
+		threading.Thread(target=count, daemon=True).start()
+
+	def update(self, images=1, bytes_in=0, error=False, skipped=False):
+		if skipped:
+			self.skipped += images
+		elif error:
+			self.errors += images
+		else:
+			self.images += images
+		self.bytes_in += bytes_in
+
+		now = time.monotonic()
+		if now - self.last >= self.interval:
+			self.last = now
+			self.report(now)
+
+	def line(self, now):
+		elapsed = max(now - self.start, 1e-9)
+		done = self.images + self.errors + self.skipped
+		text = '%d' % done
+		if self.total:
+			text += '/%d (%.1f%%)' % (self.total, 100.0 * min(done, self.total) / self.total)
+		text += ' %.1f images/s, in %.1f MB/s' % ((self.images + self.errors) / elapsed, self.bytes_in / elapsed / 1048576.0)
+		if self.bytes_out is not None:
+			text += ', out %.1f MB/s' % (self.bytes_out() / elapsed / 1048576.0)
+		if self.errors:
+			text += ', %d errors' % self.errors
+		if self.skipped:
+			text += ', %d skipped' % self.skipped
+		# skipped images take no time, so they do not count towards the rate
+		processed = self.images + self.errors
+		if self.total and processed and done < self.total:
+			text += ', %s left' % format_time((self.total - done) * elapsed / processed)
+		text += ', %s elapsed' % format_time(elapsed)
+		return text
+
+	def report(self, now=None):
+		text = self.line(now if now is not None else time.monotonic())
+		if self.tty:
+			# pad over the rest of a longer previous line
+			self.stream.write('\r' + text.ljust(self.width))
+			self.width = len(text)
+		else:
+			self.stream.write(text + '\n')
+		self.stream.flush()
+
+	def finish(self):
+		self.report()
+		if self.tty:
+			self.stream.write('\n')
+			self.stream.flush()
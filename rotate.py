@@ -1,9 +1,14 @@
 import argparse
 import numpy as np
 import os
-import imutils
 import cv2
 import random
+import output_profiles
+from profiling import profiler
+from progress import Progress
+from image_files import walk_images, iter_images
+import augment
+from output_profiles import get_profile, PROFILES
 
 # print(cv2.__version__)
 
@@ -37,11 +42,29 @@ def parse_args():
 	parser.add_argument('--mirror', action='store_true',
 		help='Adds mirror augmentation.')
 
+	parser.add_argument('--augment', type=str, nargs='+',
+		default=['rot90'],
+		choices=list(augment.VARIANTS),
+		help='Mirrored and rotated copies to write; --mirror adds flipped. (default: %(default)s)')
+
 	parser.add_argument('--file_extension', type=str,
 		default='png',
 		help='Border style to use when using the square process type ["png","jpg"] (default: %(default)s)')
 
+	parser.add_argument('--profile', action='store_true',
+		help='Time every stage of the run and print a summary; a Chrome trace is written to profile-trace.json in the output folder.')
+
+	parser.add_argument('--output_profile', type=str,
+		default='png-raw',
+		help='Encoder settings for the written images, NAME or NAME:LEVEL. ' + str(sorted(PROFILES)) + ' (default: %(default)s)')
+
 	args = parser.parse_args()
+	if args.output_profile:
+		try:
+			get_profile(args.output_profile)
+		except ValueError as e:
+			parser.error('--output_profile: ' + str(e))
+	args.augment = augment.select(args.augment, args.mirror)
 	return args
 
 
@@ -143,24 +166,10 @@ def makeScale(img,filename,scale):
 	rotateImage(img_copy,new_file,remakePath)
 
 
-def flipImage(img,filename,path):
-	flip_img = cv2.flip(img, 1)
-	flip_file = os.path.splitext(filename)[0] + "-flipped.png"
-	cv2.imwrite(os.path.join(path, flip_file), flip_img, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-
 def rotateImage(img,filename,path):
-	r = img.copy() 
-	r = imutils.rotate_bound(r, 90)
-	r_file = os.path.splitext(filename)[0] + "-rot90.png"
-	cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-
-	# r = imutils.rotate_bound(r, 90)
-	# r_file = os.path.splitext(filename)[0] + "-rot180.png"
-	# cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-
-	# r = imutils.rotate_bound(r, 90)
-	# r_file = os.path.splitext(filename)[0] + "-rot270.png"
-	# cv2.imwrite(os.path.join(path, r_file), r, [cv2.IMWRITE_PNG_COMPRESSION, 0])
+	with profiler.stage('rotateImage'):
+		for suffix, variant in augment.augment(img, args.augment):
+			output_profiles.save(variant, path, os.path.splitext(filename)[0] + suffix, output_profile)
 
 def processImage(img,filename):
 
@@ -175,26 +184,42 @@ def main():
 	global args
 	global count
 	global inter
+	global output_profile
 	args = parse_args()
+	if args.profile:
+		profiler.enable()
+	output_profile = get_profile(args.output_profile)
 	count = int(0)
 	inter = cv2.INTER_CUBIC
 	os.environ['OPENCV_IO_ENABLE_JASPER']= "true"
 
-	for root, subdirs, files in os.walk(args.input_folder):
-		print('--\nroot = ' + root)
+	progress = Progress(bytes_out=output_profiles.stats.size, redraw=not args.verbose)
+	progress.count(iter_images(args.input_folder, magic=False))
+
+	for root, subdirs, files in profiler.iterate('list', walk_images(args.input_folder)):
+		if(args.verbose): print('--\nroot = ' + root)
 
 		for subdir in subdirs:
-			print('\t- subdirectory ' + subdir)
+			if(args.verbose): print('\t- subdirectory ' + subdir)
 
 		for filename in files:
 			file_path = os.path.join(root, filename)
-			print('\t- file %s (full path: %s)' % (filename, file_path))
+			if(args.verbose): print('\t- file %s (full path: %s)' % (filename, file_path))
 			
-			img = cv2.imread(file_path)
+			with profiler.stage('read'): img = cv2.imread(file_path)
+			profiler.count_file('read', file_path)
 
 			if hasattr(img, 'copy'):
-				processImage(img,filename)
+				with profiler.stage(args.process_type): processImage(img,filename)
 				count = count + int(2)
+				profiler.image_done()
+				progress.update(bytes_in=os.path.getsize(file_path))
+			else:
+				progress.update(error=True)
+
+	progress.finish()
+	output_profiles.print_summary()
+	profiler.finish(args.output_folder + "profile-trace.json")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+import os
+import io
+import re
+import json
+import time
+import tarfile
+import threading
+
+# Packs outputs into sequential tar shards instead of one file per output, so
+# readers stream a few large files instead of opening millions of small ones.
+#
+# Shards are named shard-<number>.tar and a new one is started when the
+# current one would grow past the shard size. A shard is written to a temporary name and renamed
+# once it is complete, next to a .idx file listing the name, data offset and
+# size of each member; write_index() gathers those into one index.jsonl.
+# Shards from earlier runs are left alone, numbering continues after them.
+#
+# Only one process may write to a folder; worker processes collect their
+# encoded outputs in a ShardBuffer and hand them to the main process.
+
+def parse_size(size):
+	# 512M, 1G, 2GB or a plain number of bytes; also --max_memory of dedupe.py
+	units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+	size = size.strip().upper().rstrip('B')
+	if size and size[-1] in units:
+		return int(float(size[:-1]) * units[size[-1]])
+	return int(size)
+
+SHARD_NAME = re.compile(r'^shard-(\d+)\.tar$')
+
+class ShardWriter:
+	def __init__(self, folder, shard_size=1024**3):
+		self.folder = folder
+		self.shard_size = shard_size
+		self.lock = threading.Lock()
+		self.tar = None
+		self.entries = []
+
+		os.makedirs(folder, exist_ok=True)
+		self.number = 0
+		for name in os.listdir(folder):
+			match = SHARD_NAME.match(name)
+			if match:
+				self.number = max(self.number, int(match.group(1)) + 1)
+
+	def shard_path(self):
+		return os.path.join(self.folder, 'shard-%05d.tar' % self.number)
+
+	def open(self):
+		self.path = self.shard_path()
+		self.tar = tarfile.open(self.path + '.tmp', 'w', format=tarfile.GNU_FORMAT)
+		self.entries = []
+
+	def finish(self):
+		# move the complete shard and its index into place
+		self.tar.close()
+		with open(self.path + '.idx.tmp', 'w') as f:
+			for entry in self.entries:
+				f.write(json.dumps(entry) + '\n')
+		os.replace(self.path + '.tmp', self.path)
+		os.replace(self.path + '.idx.tmp', self.path + '.idx')
+		self.tar = None
+		self.number += 1
+
+	def add(self, name, data):
+		# returns the path the shard will have once it is finished
+		with self.lock:
+			if self.tar is not None and self.tar.offset + len(data) > self.shard_size and self.entries:
+				self.finish()
+			if self.tar is None:
+				self.open()
+
+			info = tarfile.TarInfo(name)
+			info.size = len(data)
+			info.mtime = int(time.time())
+			self.tar.addfile(info, io.BytesIO(data))
+			# the data ends padded to the next 512 byte block
+			offset = self.tar.offset - ((len(data) + 511) // 512) * 512
+			self.entries.append({'name': name, 'offset': offset, 'size': len(data)})
+			return self.path
+
+	def close(self):
+		with self.lock:
+			if self.tar is not None:
+				self.finish()
+
+class ShardBuffer:
+	# stands in for the ShardWriter in a worker process
+	def __init__(self):
+		self.members = []
+
+	def add(self, name, data):
+		self.members.append((name, data))
+		return None
+
+	def take(self):
+		members = self.members
+		self.members = []
+		return members
+
+def write_index(folder):
+	# one line per member of every finished shard, oldest shards first, so
+	# when an image was written again by a later run its last line is current
+	shards = []
+	for name in os.listdir(folder):
+		if SHARD_NAME.match(name) and os.path.exists(os.path.join(folder, name + '.idx')):
+			shards.append(name)
+
+	lines = []
+	for name in sorted(shards):
+		with open(os.path.join(folder, name + '.idx')) as f:
+			for line in f:
+				entry = json.loads(line)
+				entry['shard'] = name
+				lines.append(json.dumps(entry))
+
+	tmp_path = os.path.join(folder, 'index.jsonl.tmp')
+	with open(tmp_path, 'w') as f:
+		for line in lines:
+			f.write(line + '\n')
+	os.replace(tmp_path, os.path.join(folder, 'index.jsonl'))
@@ -4,6 +4,13 @@ import os
 import imutils
 import cv2
 import random
+from image_probe import image_info
+from fileops import place_file, LINK_TYPES
+import output_profiles
+from profiling import profiler
+from progress import Progress
+from image_files import walk_images, iter_images
+from output_profiles import get_profile, legacy_profile, PROFILES, FORMATS
 
 # print(cv2.__version__)
 
@@ -45,30 +52,53 @@ def parse_args():
 		default='png',
 		help='file type ["png","jpg"] (default: %(default)s)')
 
+	parser.add_argument('--link_type', type=str,
+		default='hardlink', choices=LINK_TYPES,
+		help='How to place images that are already in the output format; other images are re-encoded. (default: %(default)s)')
+
+	parser.add_argument('--profile', action='store_true',
+		help='Time every stage of the run and print a summary; a Chrome trace is written to profile-trace.json in the output folder.')
+
+	parser.add_argument('--output_profile', type=str,
+		default=None,
+		help='Encoder settings for re-encoded images, NAME or NAME:LEVEL; replaces --file_extension. ' + str(sorted(PROFILES)) + ' (default: png-raw, or jpg:90 when --file_extension jpg)')
 
 
 	args = parser.parse_args()
+	if args.output_profile:
+		try:
+			get_profile(args.output_profile)
+		except ValueError as e:
+			parser.error('--output_profile: ' + str(e))
 	return args
 
 
 
-def exclude(img,filename):
+def saveImage(file_path,fmt,path,filename):
+	new_file = os.path.splitext(filename)[0] + output_profile.extension
+
+	# same format: link or move the file, no need to decode it
+	if(fmt == FORMATS[output_profile.extension]):
+		with profiler.stage('place_file'): place_file(file_path, os.path.join(path, new_file), args.link_type)
+		return True
+
+	# a good header does not mean the rest of the file decodes
+	with profiler.stage('read'): img = cv2.imread(file_path)
+	if not hasattr(img, 'copy'):
+		return False
+	output_profiles.save(img, path, os.path.splitext(filename)[0], output_profile)
+	return True
+
+def exclude(file_path,fmt,h,w,filename):
 	make_path = args.output_folder + "exclude_"+str(args.min_size)+"-"+str(args.max_size)+"/"
 	if not os.path.exists(make_path):
 		os.makedirs(make_path)
 
-	(h, w) = img.shape[:2]
-
 	if((h >= args.min_size) and (h <= args.max_size) and (w >= args.min_size) and (w <= args.max_size)):
+		return saveImage(file_path,fmt,make_path,filename)
+	return True
 
-		if(args.file_extension == "png"):
-			new_file = os.path.splitext(filename)[0] + ".png"
-			cv2.imwrite(os.path.join(make_path, new_file), img, [cv2.IMWRITE_PNG_COMPRESSION, 0])
-		else:
-			new_file = os.path.splitext(filename)[0] + ".jpg"
-			cv2.imwrite(os.path.join(make_path, new_file), img, [cv2.IMWRITE_JPEG_QUALITY, 90])
-
-def sort(img,filename):
+def sort(file_path,fmt,h,w,filename):
 	make_path1 = args.output_folder + "yes/"
 	make_path2 = args.output_folder + "no/"
 	if not os.path.exists(make_path1):
@@ -76,7 +106,6 @@ def sort(img,filename):
 	if not os.path.exists(make_path2):
 		os.makedirs(make_path2)
 
-	(h, w) = img.shape[:2]
 	ratio = h/w
 
 	if(args.exact == True):
@@ -93,30 +122,46 @@ def sort(img,filename):
 		else:
 			path = make_path2
 
-	if(args.file_extension == "png"):
-		new_file = os.path.splitext(filename)[0] + ".png"
-		cv2.imwrite(os.path.join(path, new_file), img, [cv2.IMWRITE_PNG_COMPRESSION, 0])
+	return saveImage(file_path,fmt,path,filename)
+
+def processImage(file_path,filename):
+	# sizes come from the file header; only unknown formats get decoded
+	with profiler.stage('probe'): info = image_info(file_path)
+	if info is not None:
+		(fmt, w, h) = info
 	else:
-		new_file = os.path.splitext(filename)[0] + ".jpg"
-		cv2.imwrite(os.path.join(path, new_file), img, [cv2.IMWRITE_JPEG_QUALITY, 90])
-def processImage(img,filename):
+		with profiler.stage('read'): img = cv2.imread(file_path)
+		if not hasattr(img, 'copy'):
+			return False
+		fmt = None
+		(h, w) = img.shape[:2]
 
 	if args.process_type == "exclude":	
-		exclude(img,filename)
+		with profiler.stage('exclude'): return exclude(file_path,fmt,h,w,filename)
 	if args.process_type == "sort":	
-		sort(img,filename)
+		with profiler.stage('sort'): return sort(file_path,fmt,h,w,filename)
+	return True
 
 def main():
 	global args
 	global count
 	global inter
+	global output_profile
 	args = parse_args()
+	if args.profile:
+		profiler.enable()
+	if args.output_profile:
+		output_profile = get_profile(args.output_profile)
+	else:
+		output_profile = legacy_profile(args.file_extension)
 	count = int(0)
 	inter = cv2.INTER_CUBIC
 	os.environ['OPENCV_IO_ENABLE_JASPER']= "true"
 	print('processing images...')
+	progress = Progress(bytes_out=output_profiles.stats.size, redraw=not args.verbose)
+	progress.count(iter_images(args.input_folder, magic=False))
 
-	for root, subdirs, files in os.walk(args.input_folder):
+	for root, subdirs, files in profiler.iterate('list', walk_images(args.input_folder)):
 		if(args.verbose): print('--\nroot = ' + root)
 
 		for subdir in subdirs:
@@ -126,11 +171,17 @@ def main():
 			file_path = os.path.join(root, filename)
 			if(args.verbose): print('\t- file %s (full path: %s)' % (filename, file_path))
 			
-			img = cv2.imread(file_path)
-
-			if hasattr(img, 'copy'):
-				processImage(img,filename)
+			# --link_type rename moves the file away while it is processed
+			size = os.path.getsize(file_path)
+			if processImage(file_path,filename):
 				count = count + int(2)
+				progress.update(bytes_in=size)
+			else:
+				progress.update(error=True)
+
+	progress.finish()
+	output_profiles.print_summary()
+	profiler.finish(args.output_folder + "profile-trace.json")
 
 
 if __name__ == "__main__":
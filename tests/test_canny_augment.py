@@ -0,0 +1,44 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import cv2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def runScript(script, *args):
+	return subprocess.run([sys.executable, os.path.join(ROOT, script)] + list(args), capture_output=True, text=True)
+
+def writeImage(path):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	# blocks of noise, so the edge maps are not empty
+	img = np.random.RandomState(0).randint(0, 256, (12, 16, 3)).astype(np.uint8)
+	cv2.imwrite(path, cv2.resize(img, (128, 96), interpolation=cv2.INTER_NEAREST))
+
+def checkVariants(folder):
+	edges = cv2.imread(os.path.join(folder, 'img0.png'), cv2.IMREAD_UNCHANGED)
+	assert edges.shape == (96, 128)
+	flipped = cv2.imread(os.path.join(folder, 'img0-flipped.png'), cv2.IMREAD_UNCHANGED)
+	rotated = cv2.imread(os.path.join(folder, 'img0-rot90.png'), cv2.IMREAD_UNCHANGED)
+	assert np.array_equal(flipped, cv2.flip(edges, 1))
+	assert np.array_equal(rotated, cv2.rotate(edges, cv2.ROTATE_90_CLOCKWISE))
+
+def test_dataset_tools_augments_edge_maps(tmp_path):
+	input_folder = str(tmp_path / 'input') + '/'
+	output_folder = str(tmp_path / 'output') + '/'
+	writeImage(input_folder + 'img0.png')
+
+	result = runScript('dataset-tools.py', '--input_folder', input_folder, '--output_folder', output_folder,
+		'--process_type', 'canny', '--max_size', '128', '--augment', 'flipped', 'rot90')
+	assert result.returncode == 0, result.stderr
+	checkVariants(output_folder + 'canny-128')
+
+def test_nested_dataset_tools_augments_edge_maps(tmp_path):
+	input_folder = str(tmp_path / 'input') + '/'
+	output_folder = str(tmp_path / 'output') + '/'
+	writeImage(input_folder + 'class/img0.png')
+
+	result = runScript('nested-dataset-tools.py', '--input_folder', input_folder, '--output_folder', output_folder,
+		'--process_type', 'canny', '--max_size', '128', '--augment', 'flipped', 'rot90')
+	assert result.returncode == 0, result.stderr
+	checkVariants(output_folder + 'canny-128/class')
@@ -0,0 +1,47 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import cv2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def runSort(*args):
+	return subprocess.run([sys.executable, os.path.join(ROOT, 'sort.py')] + list(args), capture_output=True, text=True)
+
+def writeImage(path, w, h, **kwargs):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	img = np.random.RandomState(0).randint(0, 256, (h, w, 3)).astype(np.uint8)
+	cv2.imwrite(path, img, **kwargs)
+	return img
+
+def test_sort_with_rename_moves_inputs(tmp_path):
+	input_folder = str(tmp_path / 'input') + '/'
+	output_folder = str(tmp_path / 'output') + '/'
+	img = writeImage(input_folder + 'tall.png', 32, 64)
+	writeImage(input_folder + 'wide.png', 64, 32)
+
+	result = runSort('--input_folder', input_folder, '--output_folder', output_folder,
+		'--process_type', 'sort', '--link_type', 'rename')
+	assert result.returncode == 0, result.stderr
+
+	assert not os.path.exists(input_folder + 'tall.png')
+	assert not os.path.exists(input_folder + 'wide.png')
+	assert np.array_equal(cv2.imread(output_folder + 'yes/tall.png'), img)
+	assert os.path.exists(output_folder + 'no/wide.png')
+
+def test_sort_skips_images_that_do_not_decode(tmp_path):
+	input_folder = str(tmp_path / 'input') + '/'
+	output_folder = str(tmp_path / 'output') + '/'
+	writeImage(input_folder + 'good.jpg', 32, 64)
+	writeImage(input_folder + 'truncated.jpg', 32, 64)
+	# the header still gives the size, the pixels are gone
+	with open(input_folder + 'truncated.jpg', 'r+b') as f:
+		f.truncate(200)
+
+	result = runSort('--input_folder', input_folder, '--output_folder', output_folder, '--process_type', 'sort')
+	assert result.returncode == 0, result.stderr
+
+	assert os.path.exists(output_folder + 'yes/good.png')
+	assert not os.path.exists(output_folder + 'yes/truncated.png')
+	assert '1 errors' in result.stderr
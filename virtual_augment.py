@@ -0,0 +1,151 @@
+import os
+import json
+import argparse
+import numpy as np
+import cv2
+import augment
+
+# --augment_mode virtual: instead of writing the mirrored and rotated copies
+# and the crops of crop_square_patch and many_squares, dataset-tools.py adds
+# a line to virtual.jsonl in the output folder that says how to make the
+# image when it is read:
+#
+#   {"name": "many_squares-512/a-1-rot90.png", "source": "../input/a.jpg",
+#    "read": 1, "box": [0, 0, 800, 800], "size": [512, 512], "variant": "rot90"}
+#
+# source is read with the OpenCV imread flag read, cut to box (x, y, width,
+# height), resized to size and turned by variant; everything but name and
+# source is optional. Paths are relative to the output folder, and sources
+# that were packed into tar shards are found through index.jsonl.
+#
+# Like the manifest, lines are appended as images finish and the last line
+# of a name is the one that counts.
+
+INDEX = 'virtual.jsonl'
+
+class VirtualIndex:
+	def __init__(self, folder):
+		self.path = os.path.join(folder, INDEX)
+		self.names = set()
+		self.lines = 0
+		# without the index of earlier runs their records are gone too
+		self.found = os.path.exists(self.path)
+		if self.found:
+			for record in records(folder):
+				self.names.add(record['name'])
+				self.lines += 1
+
+		# opened with the first record
+		self.file = None
+
+	def add(self, added):
+		if self.file is None:
+			os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+			self.file = open(self.path, 'a')
+		for record in added:
+			self.file.write(json.dumps(record) + '\n')
+			self.names.add(record['name'])
+			self.lines += 1
+		self.file.flush()
+
+	def close(self):
+		if self.file is None:
+			return
+		self.file.close()
+
+		# rewrite the file once most lines are superseded
+		if self.lines > 2 * len(self.names):
+			current = dict((record['name'], record) for record in records(os.path.dirname(self.path)))
+			tmp_path = self.path + '.tmp'
+			with open(tmp_path, 'w') as f:
+				for record in current.values():
+					f.write(json.dumps(record) + '\n')
+			os.replace(tmp_path, self.path)
+
+def records(folder):
+	# every line of the index, older ones first
+	with open(os.path.join(folder, INDEX)) as f:
+		for line in f:
+			try:
+				yield json.loads(line)
+			except ValueError:
+				# a run that was killed mid-write
+				continue
+
+class VirtualLoader:
+	def __init__(self, folder):
+		self.folder = folder
+		self.members = {}
+		index_path = os.path.join(folder, 'index.jsonl')
+		if os.path.exists(index_path):
+			with open(index_path) as f:
+				for line in f:
+					entry = json.loads(line)
+					self.members[entry['name']] = entry
+		# the variants of an image follow it, so one decoded source goes a long way
+		self.cached = (None, None)
+
+	def read(self, source, flags):
+		if self.cached[0] == (source, flags):
+			return self.cached[1]
+
+		path = os.path.join(self.folder, source)
+		if os.path.exists(path) or source not in self.members:
+			img = cv2.imread(path, flags)
+		else:
+			entry = self.members[source]
+			with open(os.path.join(self.folder, entry['shard']), 'rb') as f:
+				f.seek(entry['offset'])
+				data = f.read(entry['size'])
+			img = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+		if img is None:
+			raise IOError('could not read ' + path)
+		self.cached = ((source, flags), img)
+		return img
+
+	def load(self, record):
+		img = self.read(record['source'], record.get('read', cv2.IMREAD_UNCHANGED))
+		if 'box' in record:
+			(x, y, w, h) = record['box']
+			img = img[y:y+h, x:x+w]
+		if 'size' in record:
+			img = cv2.resize(img, tuple(record['size']), interpolation=cv2.INTER_CUBIC)
+		if 'variant' in record:
+			img = augment.VARIANTS[record['variant']](img)
+		return img
+
+	def images(self):
+		# yields the name and pixels of every image in the index
+		current = dict((record['name'], record) for record in records(self.folder))
+		for name, record in current.items():
+			yield name, self.load(record)
+
+def parse_args():
+	desc = "Write out the images of a virtual.jsonl written with --augment_mode virtual"
+	parser = argparse.ArgumentParser(description=desc)
+
+	parser.add_argument('--input_folder', type=str,
+		default='./output/',
+		help='Output folder of the dataset-tools.py run, with virtual.jsonl in it. (default: %(default)s)')
+
+	parser.add_argument('--output_folder', type=str,
+		default='./virtual/',
+		help='Directory path to write the images to. (default: %(default)s)')
+
+	args = parser.parse_args()
+	return args
+
+def main():
+	args = parse_args()
+	loader = VirtualLoader(args.input_folder)
+	count = 0
+	for name, img in loader.images():
+		file_path = os.path.join(args.output_folder, name)
+		os.makedirs(os.path.dirname(file_path), exist_ok=True)
+		cv2.imwrite(file_path, img)
+		count += 1
+	print('%d images written to %s' % (count, args.output_folder))
+
+
+if __name__ == "__main__":
+	main()